@@ -0,0 +1,157 @@
+"""
+Rerun benchmark for the Streamlit frontend.
+
+Drives the app with Streamlit's AppTest against stub_backend.py (stages set
+to zero, so only frontend time is measured) and reports, per phase, the
+CPU and wall time of a script run and the backend requests it made. CPU
+time is the figure to compare: AppTest waits for a run by polling, which
+rounds wall time up to its poll interval.
+
+    cold login    first run of a fresh session, not logged in
+    login rerun   steady-state rerun of the login page
+    login         the run that submits the login form
+    chat rerun    steady-state rerun of the chat page
+
+Each app runs in a fresh interpreter so process-wide caches start empty,
+--rounds times, alternating between apps; the median round is reported.
+Pass --app more than once to compare two versions of the script.
+
+    python bench_reruns.py --threads 20 --reruns 10 --rounds 5
+    python bench_reruns.py --app old_user_ui2.py --app user_ui2.py
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import ThreadingHTTPServer
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+APP = os.path.join(HERE, "user_ui2.py")
+PHASES = ("cold login", "login rerun", "login", "chat rerun")
+
+
+def start_backend(threads):
+    """Stub backend with one user owning `threads` threads of a few messages"""
+    import requests
+    import stub_backend
+
+    class CountingHandler(stub_backend.StubHandler):
+        requests = 0
+
+        def handle_one(self, method):
+            CountingHandler.requests += 1
+            super().handle_one(method)
+
+    CountingHandler.store = stub_backend.Store()
+    CountingHandler.stages = {name: (0, name) for name in ("embedding", "retrieval", "llm")}
+    server = ThreadingHTTPServer(("127.0.0.1", 0), CountingHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+
+    tokens = requests.post(f"{url}/auth/register", json={
+        "username": "bench", "email": "bench@example.com", "password": "benchpass"
+    }).json()
+    auth = {"Authorization": f"Bearer {tokens['access_token']}"}
+    for n in range(threads):
+        thread_id = requests.post(f"{url}/threads/new", headers=auth).json()["thread_id"]
+        for turn in range(3):
+            requests.post(f"{url}/chat", headers=auth,
+                          json={"message": f"question {turn} in thread {n}", "thread_id": thread_id})
+    CountingHandler.requests = 0
+    return url, CountingHandler
+
+
+def run_child(args):
+    app = os.path.abspath(args.app)
+    url, handler = start_backend(args.threads)
+    os.environ["API_BASE_UL"] = url
+    # Local stores (metrics, outbox, ...) go to a scratch directory
+    os.chdir(tempfile.mkdtemp(prefix="bench_reruns_"))
+    sys.path.insert(0, os.path.dirname(app))
+    from streamlit.runtime.scriptrunner.script_cache import ScriptCache
+    from streamlit.testing.v1 import AppTest, local_script_runner
+
+    # AppTest compiles the script afresh on every run; the server compiles it
+    # once per process. Share one cache so reruns cost what they do in a server.
+    script_cache = ScriptCache()
+    local_script_runner.ScriptCache = lambda: script_cache
+
+    at = AppTest.from_file(app, default_timeout=120)
+    results = {}
+
+    def measure(phase, action=None, times=1):
+        cpu, wall, counts = [], [], []
+        for _ in range(times):
+            if action:
+                action()
+            before = handler.requests
+            started, started_cpu = time.perf_counter(), time.process_time()
+            at.run()
+            cpu.append((time.process_time() - started_cpu) * 1000)
+            wall.append((time.perf_counter() - started) * 1000)
+            counts.append(handler.requests - before)
+            if at.exception:
+                raise RuntimeError(f"{phase}: {at.exception[0].message}")
+        results[phase] = {
+            "cpu_ms": statistics.median(cpu),
+            "wall_ms": statistics.median(wall),
+            "requests": statistics.median(counts)
+        }
+
+    def submit_login():
+        at.text_input[0].input("bench")
+        at.text_input[1].input("benchpass")
+        at.button[0].click()
+
+    measure("cold login")
+    measure("login rerun", times=args.reruns)
+    measure("login", submit_login)
+    if not at.chat_input:
+        # Login ends in st.rerun(); AppTest stops there, so render the chat page
+        at.run()
+    measure("chat rerun", times=args.reruns)
+    print(json.dumps(results))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--app", action="append")
+    parser.add_argument("--threads", type=int, default=20)
+    parser.add_argument("--reruns", type=int, default=10)
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--child", action="store_true")
+    args = parser.parse_args()
+    args.app = args.app or [APP]
+
+    if args.child:
+        args.app = args.app[0]
+        return run_child(args)
+
+    print(f"{args.threads} threads, median of {args.reruns} reruns, {args.rounds} rounds")
+    print(f"{'':>12}" + "".join(f"{os.path.basename(app):>36}" for app in args.app))
+    rounds = {app: [] for app in args.app}
+    for _ in range(args.rounds):
+        for app in args.app:
+            out = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), "--child", "--app", app,
+                 "--threads", str(args.threads), "--reruns", str(args.reruns)],
+                check=True, capture_output=True, text=True, cwd=HERE
+            )
+            rounds[app].append(json.loads(out.stdout.strip().splitlines()[-1]))
+    for phase in PHASES:
+        row = f"{phase:>12}"
+        for app in args.app:
+            runs = [r[phase] for r in rounds[app]]
+            row += (f"{statistics.median(r['cpu_ms'] for r in runs):9.1f} ms cpu"
+                    f"{statistics.median(r['wall_ms'] for r in runs):8.0f} ms"
+                    f"{statistics.median(r['requests'] for r in runs):4.0f} reqs")
+        print(row)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
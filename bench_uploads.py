@@ -0,0 +1,133 @@
+"""
+Peak-memory benchmark for parallel document uploads.
+
+Sends N uploads at once to a local sink server, once with requests'
+files= (which builds the multipart body in memory) and once with the
+streaming MultipartStream. Each mode runs in a fresh interpreter and reports
+its peak RSS above the baseline taken after the source files exist.
+
+    python bench_uploads.py --uploads 20 --size-mb 20
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+class SinkHandler(BaseHTTPRequestHandler):
+    """Reads and discards the request body in chunks"""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        if self.headers.get("Transfer-Encoding") == "chunked":
+            while True:
+                size = int(self.rfile.readline().strip(), 16)
+                self.rfile.read(size + 2)
+                if size == 0:
+                    break
+        else:
+            remaining = int(self.headers.get("Content-Length") or 0)
+            while remaining:
+                remaining -= len(self.rfile.read(min(remaining, 1024 * 1024)))
+        body = b'{"job_id": "bench", "status": "processing"}'
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def make_source(size, on_disk):
+    """A file-like source on disk, or held in memory like Streamlit's UploadedFile"""
+    if on_disk:
+        source = tempfile.TemporaryFile()
+    else:
+        source = tempfile.SpooledTemporaryFile(max_size=size + 1)
+    block = os.urandom(1024 * 1024)
+    written = 0
+    while written < size:
+        chunk = block[:size - written]
+        source.write(chunk)
+        written += len(chunk)
+    source.seek(0)
+    return source
+
+
+def run_child(args):
+    import requests
+    from upload_stream import MultipartStream
+
+    sources = [make_source(args.size_mb * 1024 * 1024, args.source == "disk")
+               for _ in range(args.uploads)]
+    baseline = peak_rss_mb()
+
+    def upload(source):
+        if args.mode == "buffered":
+            files = {"file": ("bench.pdf", source, "application/pdf")}
+            response = requests.post(args.url, files=files, timeout=300)
+        else:
+            body = MultipartStream("file", "bench.pdf", source, "application/pdf")
+            response = requests.post(args.url, data=body, timeout=300,
+                                     headers={"Content-Type": body.content_type})
+        response.raise_for_status()
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.uploads) as pool:
+        list(pool.map(upload, sources))
+    print(json.dumps({
+        "seconds": time.perf_counter() - started,
+        "baseline_mb": baseline,
+        "peak_mb": peak_rss_mb()
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--uploads", type=int, default=20)
+    parser.add_argument("--size-mb", type=int, default=20)
+    parser.add_argument("--source", choices=("disk", "memory"), default="disk")
+    parser.add_argument("--mode", choices=("buffered", "streaming"))
+    parser.add_argument("--url")
+    args = parser.parse_args()
+
+    if args.mode:
+        return run_child(args)
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), SinkHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}/documents/upload"
+
+    print(f"{args.uploads} parallel uploads of {args.size_mb} MB ({args.source} sources)")
+    for mode in ("buffered", "streaming"):
+        out = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--mode", mode, "--url", url,
+             "--uploads", str(args.uploads), "--size-mb", str(args.size_mb),
+             "--source", args.source],
+            check=True, capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        )
+        result = json.loads(out.stdout)
+        growth = result["peak_mb"] - result["baseline_mb"]
+        print(f"{mode:>10}: peak RSS {result['peak_mb']:7.1f} MB "
+              f"(+{growth:6.1f} MB over baseline) in {result['seconds']:.2f}s")
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,49 @@
+"""
+PDF pre-flight for the Streamlit frontend.
+
+Kept in its own module so it can run in a worker process: Streamlit executes
+user_ui2.py as __main__, which a process pool cannot import by name.
+"""
+import io
+
+
+def inspect_pdf(data):
+    """
+    Extract text from a PDF and report whether the backend will find any.
+
+    Returns a dict with the joined page text, the character offset where each
+    page starts in it, and how many pages carry images but no text (a hint
+    that the PDF is a scan).
+    """
+    from pypdf import PdfReader
+
+    try:
+        reader = PdfReader(io.BytesIO(data))
+        if reader.is_encrypted:
+            reader.decrypt("")
+
+        pages = []
+        page_offsets = []
+        image_pages = 0
+        offset = 0
+        for page in reader.pages:
+            text = page.extract_text() or ""
+            if not text.strip():
+                resources = page.get("/Resources") or {}
+                if "/XObject" in resources:
+                    image_pages += 1
+            page_offsets.append(offset)
+            pages.append(text)
+            offset += len(text) + 1
+    except Exception as e:
+        return {"ok": False, "error": str(e)}
+
+    text = "\n".join(pages)
+    return {
+        "ok": True,
+        "pages": len(pages),
+        "text": text,
+        "page_offsets": page_offsets,
+        "chars": len(text.strip()),
+        "image_pages": image_pages,
+    }
@@ -0,0 +1,36 @@
+"""
+ASGI entry point: the Streamlit app plus the route that writes its
+HTTP-only cookies (see session_resume.py).
+
+    streamlit run serve.py
+    uvicorn serve:app --port 8501
+"""
+from starlette.responses import Response
+from starlette.routing import Route
+
+import streamlit as st
+
+import session_resume
+
+
+async def commit_resume_cookie(request):
+    """Set (or clear) the cookie the app sealed in the posted token"""
+    staged = session_resume.take((await request.body()).decode("ascii", "replace"))
+    if staged is None:
+        return Response(status_code=404)
+
+    name, value, max_age = staged
+    attrs = {"path": "/", "httponly": True, "secure": request.url.scheme == "https",
+             "samesite": "strict"}
+    response = Response(status_code=204, headers={"Cache-Control": "no-store"})
+    if value:
+        response.set_cookie(name, value, max_age=max_age, **attrs)
+    else:
+        response.delete_cookie(name, **attrs)
+    return response
+
+
+app = st.App(
+    "user_ui2.py",
+    routes=[Route(session_resume.COMMIT_PATH, commit_resume_cookie, methods=["POST"])]
+)
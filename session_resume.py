@@ -0,0 +1,84 @@
+"""
+HTTP-only cookies for the Streamlit frontend: the signed session-resume
+cookie, and the session-store cookie carrying the server-issued sid and
+the key its stored state is encrypted with.
+
+Kept in its own module because two sides share it: the app script
+(re-executed as __main__ on every rerun) stages cookie values, and
+serve.py's route, which runs outside any script, hands them to the
+browser. A staged value travels sealed in the token itself, so the
+browser's POST may land on any replica that shares SESSION_COOKIE_SECRET.
+"""
+import base64
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import time
+import zlib
+
+from cryptography.fernet import Fernet, InvalidToken
+
+COOKIE_NAME = "rag_resume"
+SID_COOKIE_NAME = "rag_sid"
+COMMIT_PATH = "/session/resume-cookie"
+STAGE_TTL = 60
+
+# The same on every replica; without one (or SESSION_RESUME_SECRET) a key of
+# this process's own only works behind sticky sessions
+STAGE_SECRET = (os.getenv("SESSION_COOKIE_SECRET") or os.getenv("SESSION_RESUME_SECRET")
+                or secrets.token_urlsafe(32))
+_stage_fernet = Fernet(base64.urlsafe_b64encode(
+    hashlib.sha256(b"stage:" + STAGE_SECRET.encode("utf-8")).digest()
+))
+
+
+def _b64(data):
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+
+def _unb64(text):
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+
+def _mac(body, secret):
+    return hmac.new(secret.encode("utf-8"), body.encode("ascii"), hashlib.sha256).digest()
+
+
+def sign(payload, secret):
+    """Compressed JSON plus an HMAC-SHA256 over it: '<body>.<mac>'"""
+    body = _b64(zlib.compress(json.dumps(dict(payload, iat=int(time.time()))).encode("utf-8")))
+    return f"{body}.{_b64(_mac(body, secret))}"
+
+
+def verify(value, secret, max_age):
+    """The payload of a cookie we signed within max_age seconds, else None"""
+    body, _, mac = (value or "").partition(".")
+    try:
+        if not hmac.compare_digest(_unb64(mac), _mac(body, secret)):
+            return None
+        payload = json.loads(zlib.decompress(_unb64(body)))
+    except (ValueError, zlib.error):
+        return None
+    if time.time() - payload.get("iat", 0) > max_age:
+        return None
+    return payload
+
+
+def stage(value, max_age, name=COOKIE_NAME):
+    """
+    Seal a cookie (value None clears it) into a token for the browser to
+    redeem at COMMIT_PATH within STAGE_TTL. The token is encrypted, so the
+    value itself never reaches page JavaScript.
+    """
+    return _stage_fernet.encrypt(json.dumps([name, value, max_age]).encode("utf-8")).decode("ascii")
+
+
+def take(token):
+    """(name, value, max_age) sealed in token; None if forged or expired"""
+    try:
+        name, value, max_age = json.loads(_stage_fernet.decrypt(token.encode("ascii"), ttl=STAGE_TTL))
+    except (InvalidToken, ValueError, UnicodeEncodeError):
+        return None
+    return name, value, max_age
@@ -0,0 +1,244 @@
+"""
+Local stand-in for the RAG backend, for tracing the frontend end to end.
+
+Speaks just enough of the API for user_ui2.py to log in, chat, page
+history and upload documents. /chat sleeps through simulated embedding,
+retrieval and LLM stages and reports them in a Server-Timing header, so
+the "Show timings" breakdown has something real to show. Every request's
+traceparent is logged next to the server's own span, and echoed back in a
+traceresponse header.
+
+    python stub_backend.py --port 8000 --llm-ms 800
+    API_BASE_UL=http://127.0.0.1:8000 streamlit run user_ui2.py
+"""
+import argparse
+import json
+import random
+import re
+import secrets
+import sys
+import threading
+import time
+import uuid
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+TRACEPARENT = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-[0-9a-f]{2}$")
+
+
+class Store:
+    """Users, threads and documents, all in memory"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.users = {}
+        self.tokens = {}
+        self.threads = {}
+        self.documents = []
+        self.jobs = {}
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    store = None
+    stages = None
+
+    def log_message(self, *args):
+        pass
+
+    # ---------------- plumbing ----------------
+    def read_body(self):
+        if self.headers.get("Transfer-Encoding") == "chunked":
+            data = b""
+            while True:
+                size = int(self.rfile.readline().strip(), 16)
+                chunk = self.rfile.read(size + 2)
+                if size == 0:
+                    break
+                data += chunk[:-2]
+            return data
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def send(self, status, payload, content_type="application/json", timing=None):
+        body = payload if isinstance(payload, bytes) else json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        if timing:
+            self.send_header("Server-Timing", ", ".join(
+                f'{name};dur={ms:.1f};desc="{desc}"' for name, ms, desc in timing
+            ))
+        if self.trace_id:
+            self.send_header("traceresponse", f"00-{self.trace_id}-{self.span_id}-01")
+        self.end_headers()
+        self.wfile.write(body)
+        self.status = status
+
+    def user(self):
+        auth = self.headers.get("Authorization", "")
+        return self.store.tokens.get(auth.removeprefix("Bearer "))
+
+    def issue_tokens(self, username):
+        access, refresh = secrets.token_hex(16), secrets.token_hex(16)
+        self.store.tokens[access] = username
+        self.store.tokens[refresh] = username
+        return {"access_token": access, "refresh_token": refresh, "token_type": "bearer"}
+
+    def stage(self, name):
+        """Sleep for one simulated stage; returns its Server-Timing entry"""
+        base, desc = self.stages[name]
+        started = time.perf_counter()
+        time.sleep(max(0.0, random.gauss(base, base * 0.2)) / 1000)
+        return name, (time.perf_counter() - started) * 1000, desc
+
+    def handle_one(self, method):
+        self.status = None
+        match = TRACEPARENT.match(self.headers.get("traceparent", ""))
+        self.trace_id, parent_id = match.groups() if match else (None, None)
+        self.span_id = secrets.token_hex(8)
+        url = urlparse(self.path)
+        started = time.perf_counter()
+        try:
+            self.route(method, url.path, parse_qs(url.query), self.read_body())
+        finally:
+            print(
+                f"{method} {url.path} {self.status} "
+                f"{(time.perf_counter() - started) * 1000:.0f}ms "
+                f"trace={self.trace_id or '-'} parent={parent_id or '-'} span={self.span_id}",
+                file=sys.stderr
+            )
+
+    def do_GET(self):
+        self.handle_one("GET")
+
+    def do_POST(self):
+        self.handle_one("POST")
+
+    def do_DELETE(self):
+        self.handle_one("DELETE")
+
+    # ---------------- API ----------------
+    def route(self, method, path, query, body):
+        store = self.store
+        if path == "/health":
+            return self.send(200, {"status": "ok"})
+
+        if path in ("/auth/register", "/auth/login"):
+            data = json.loads(body or b"{}")
+            with store.lock:
+                if path == "/auth/register":
+                    if data.get("username") in store.users:
+                        return self.send(400, {"detail": "Username already taken"})
+                    store.users[data["username"]] = data.get("password")
+                elif store.users.get(data.get("username"), object()) != data.get("password"):
+                    return self.send(401, {"detail": "Invalid credentials"})
+                tokens = self.issue_tokens(data["username"])
+            return self.send(201 if path == "/auth/register" else 200, tokens)
+
+        username = self.user()
+        if username is None:
+            return self.send(401, {"detail": "Not authenticated"})
+
+        if path == "/auth/refresh":
+            with store.lock:
+                return self.send(200, self.issue_tokens(username))
+        if path == "/auth/me":
+            return self.send(200, {"id": username, "username": username})
+
+        if path == "/threads" and method == "GET":
+            with store.lock:
+                threads = [tid for tid, t in store.threads.items() if t["owner"] == username]
+            return self.send(200, {"threads": threads[::-1]})
+        if path == "/threads/new" and method == "POST":
+            thread_id = str(uuid.uuid4())
+            with store.lock:
+                store.threads[thread_id] = {"owner": username, "title": None, "messages": []}
+            return self.send(200, {"thread_id": thread_id})
+        match = re.fullmatch(r"/threads/([^/]+)/(history|title)", path)
+        if match:
+            thread = store.threads.get(match.group(1))
+            if thread is None or thread["owner"] != username:
+                return self.send(404, {"detail": "Thread not found"})
+            if match.group(2) == "title":
+                thread["title"] = json.loads(body or b"{}").get("title")
+                return self.send(200, {"ok": True})
+            messages = list(thread["messages"])
+            if "ndjson" not in self.headers.get("Accept", ""):
+                return self.send(200, {"messages": messages})
+            offset = int(query.get("offset", [0])[0])
+            limit = int(query.get("limit", [len(messages)])[0])
+            window = messages[::-1][offset:offset + limit]
+            lines = "".join(json.dumps(m) + "\n" for m in window).encode()
+            return self.send(200, lines, "application/x-ndjson")
+
+        if path == "/chat" and method == "POST":
+            data = json.loads(body or b"{}")
+            thread = store.threads.get(data.get("thread_id"))
+            if thread is None or thread["owner"] != username:
+                return self.send(404, {"detail": "Thread not found"})
+            timing = [self.stage("embedding"), self.stage("retrieval"), self.stage("llm")]
+            sources = ", ".join(store.documents[:3]) or "no documents"
+            reply = f"(stub) You asked: {data.get('message', '')}\n\nSources: {sources}"
+            with store.lock:
+                thread["messages"] += [
+                    {"role": "user", "content": data.get("message", "")},
+                    {"role": "assistant", "content": reply}
+                ]
+            return self.send(200, {"reply": reply, "thread_id": data["thread_id"]}, timing=timing)
+
+        if path == "/documents" and method == "GET":
+            return self.send(200, {"documents": list(store.documents)})
+        if path == "/documents" and method == "DELETE":
+            with store.lock:
+                store.documents.clear()
+            return self.send(200, {"ok": True})
+        if path == "/documents/upload" and method == "POST":
+            match = re.search(rb'filename="([^"]*)"', body[:4096])
+            filename = match.group(1).decode() if match else "upload.pdf"
+            job_id = uuid.uuid4().hex
+            with store.lock:
+                if filename not in store.documents:
+                    store.documents.append(filename)
+                store.jobs[job_id] = time.time()
+            return self.send(200, {"job_id": job_id, "status": "processing",
+                                   "message": f"{filename} queued"})
+        if path.startswith("/documents/upload-status/") and method == "GET":
+            queued = store.jobs.get(path.rsplit("/", 1)[1])
+            if queued is None:
+                return self.send(404, {"detail": "Unknown job"})
+            return self.send(200, {"status": "done" if time.time() - queued > 2 else "processing"})
+        if path.startswith("/documents/") and method == "DELETE":
+            filename = path.split("/", 2)[2]
+            with store.lock:
+                if filename in store.documents:
+                    store.documents.remove(filename)
+            return self.send(200, {"ok": True})
+
+        return self.send(404, {"detail": "Not found"})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--embedding-ms", type=float, default=40)
+    parser.add_argument("--retrieval-ms", type=float, default=120)
+    parser.add_argument("--llm-ms", type=float, default=900)
+    args = parser.parse_args()
+
+    StubHandler.store = Store()
+    StubHandler.stages = {
+        "embedding": (args.embedding_ms, "Query embedding"),
+        "retrieval": (args.retrieval_ms, "Vector search"),
+        "llm": (args.llm_ms, "LLM generation"),
+    }
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), StubHandler)
+    print(f"stub backend on http://127.0.0.1:{args.port}", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    sys.exit(main())
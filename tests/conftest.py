@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The modules under test sit at the repository root, next to user_ui2.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
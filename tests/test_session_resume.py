@@ -0,0 +1,57 @@
+import time
+
+import session_resume
+
+SECRET = "s3cret"
+
+
+def test_signed_cookie_round_trips():
+    value = session_resume.sign({"refresh_token": "R", "chat_thread": ["t1"]}, SECRET)
+    payload = session_resume.verify(value, SECRET, 60)
+    assert payload["refresh_token"] == "R"
+    assert payload["chat_thread"] == ["t1"]
+
+
+def test_tampered_body_is_rejected():
+    body, _, mac = session_resume.sign({"refresh_token": "R"}, SECRET).partition(".")
+    forged = session_resume.sign({"refresh_token": "attacker"}, "other").partition(".")[0]
+    assert session_resume.verify(f"{forged}.{mac}", SECRET, 60) is None
+    assert session_resume.verify(f"{body[:-2]}AA.{mac}", SECRET, 60) is None
+
+
+def test_tampered_mac_is_rejected():
+    body, _, mac = session_resume.sign({"refresh_token": "R"}, SECRET).partition(".")
+    assert session_resume.verify(f"{body}.{mac[:-2]}AA", SECRET, 60) is None
+    assert session_resume.verify(body, SECRET, 60) is None
+
+
+def test_other_secret_is_rejected():
+    value = session_resume.sign({"refresh_token": "R"}, "other")
+    assert session_resume.verify(value, SECRET, 60) is None
+
+
+def test_expired_cookie_is_rejected(monkeypatch):
+    value = session_resume.sign({"refresh_token": "R"}, SECRET)
+    now = time.time()
+    monkeypatch.setattr(session_resume.time, "time", lambda: now + 61)
+    assert session_resume.verify(value, SECRET, 60) is None
+    assert session_resume.verify(value, SECRET, 120)["refresh_token"] == "R"
+
+
+def test_garbage_is_rejected():
+    for value in (None, "", ".", "not-a-cookie", "a.b.c", "%%%.###"):
+        assert session_resume.verify(value, SECRET, 60) is None
+
+
+def test_staged_cookie_round_trips_and_rejects_tampering():
+    token = session_resume.stage("sid.key", 99, name=session_resume.SID_COOKIE_NAME)
+    assert session_resume.take(token) == (session_resume.SID_COOKIE_NAME, "sid.key", 99)
+    assert session_resume.take(token[:-4] + "AAAA") is None
+    assert session_resume.take("") is None
+
+
+def test_expired_staged_cookie_is_rejected(monkeypatch):
+    token = session_resume.stage(None, 5)
+    now = time.time()
+    monkeypatch.setattr(session_resume.time, "time", lambda: now + session_resume.STAGE_TTL + 5)
+    assert session_resume.take(token) is None
@@ -0,0 +1,55 @@
+import io
+from email.parser import BytesParser
+
+from upload_stream import MultipartStream
+
+
+def encode(filename, content_type=None, data=b"%PDF-1.4 body"):
+    stream = MultipartStream("file", filename, io.BytesIO(data), content_type)
+    body = b"".join(stream)
+    assert len(body) == len(stream)
+    return stream, body
+
+
+def parts(stream, body):
+    message = BytesParser().parsebytes(
+        f"Content-Type: {stream.content_type}\r\n\r\n".encode() + body
+    )
+    return message.get_payload()
+
+
+def test_plain_filename_is_sent_unchanged():
+    stream, body = encode("report 2024.pdf")
+    [part] = parts(stream, body)
+    assert part.get_filename() == "report 2024.pdf"
+    assert part.get_payload(decode=True) == b"%PDF-1.4 body"
+
+
+def test_crlf_in_filename_cannot_start_a_new_header_or_part():
+    stream, body = encode('a.pdf"\r\nContent-Type: text/html\r\n\r\n--x\r\nX: "y')
+    head = body.split(b"\r\n\r\n", 1)[0]
+    assert head.count(b"\r\n") == 2
+    assert b'filename="a.pdf%22%0D%0AContent-Type: text/html%0D%0A%0D%0A--x%0D%0AX: %22y"' in head
+    [part] = parts(stream, body)
+    assert part.get_content_type() == "application/octet-stream"
+
+
+def test_lone_cr_and_lf_are_encoded():
+    _, body = encode("a\rb\nc.pdf")
+    assert b'filename="a%0Db%0Ac.pdf"' in body
+
+
+def test_quote_in_field_and_filename_is_encoded():
+    stream = MultipartStream('fi"eld', 'say "hi".pdf', io.BytesIO(b""))
+    assert b'name="fi%22eld"; filename="say %22hi%22.pdf"' in stream.head
+
+
+def test_backslash_is_sent_as_browsers_send_it():
+    _, body = encode("C:\\docs\\a.pdf")
+    assert b'filename="C:\\docs\\a.pdf"' in body
+
+
+def test_line_breaks_are_dropped_from_content_type():
+    stream, _ = encode("a.pdf", content_type="application/pdf\r\nX-Injected: 1")
+    assert b"Content-Type: application/pdfX-Injected: 1\r\n\r\n" in stream.head
+    assert b"\r\nX-Injected" not in stream.head
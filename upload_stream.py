@@ -0,0 +1,83 @@
+"""
+Streaming multipart/form-data encoder for document uploads.
+
+Kept in its own module so bench_uploads.py can measure it without running
+the Streamlit app.
+"""
+import os
+import secrets
+
+CHUNK_SIZE = 64 * 1024
+
+
+def _quote(value):
+    """
+    A value for a quoted Content-Disposition parameter. CR, LF and '"' are
+    percent-encoded as browsers do (HTML form encoding), so a crafted
+    filename can't end the header or start a new part. Nothing else is
+    touched: browsers send backslashes as they are.
+    """
+    return value.replace('"', "%22").replace("\r", "%0D").replace("\n", "%0A")
+
+
+class MultipartStream:
+    """
+    A one-file multipart body that requests sends as a stream: each read()
+    returns the next piece of the header, of the file (at most chunk_size
+    bytes at a time) or of the closing boundary. Nothing is copied into a
+    full in-memory body. It has a length, so it goes out with Content-Length
+    instead of chunked encoding.
+    """
+
+    def __init__(self, field, filename, fileobj, content_type=None, chunk_size=CHUNK_SIZE):
+        self.boundary = secrets.token_hex(16)
+        self.content_type = f"multipart/form-data; boundary={self.boundary}"
+        self.fileobj = fileobj
+        self.chunk_size = chunk_size
+
+        # Client-supplied, so it must not be able to break out of its header line
+        content_type = "".join((content_type or "application/octet-stream").splitlines())
+        self.head = (
+            f"--{self.boundary}\r\n"
+            f'Content-Disposition: form-data; name="{_quote(field)}"; filename="{_quote(filename)}"\r\n'
+            f"Content-Type: {content_type}\r\n\r\n"
+        ).encode("utf-8")
+        self.tail = f"\r\n--{self.boundary}--\r\n".encode("utf-8")
+
+        fileobj.seek(0, os.SEEK_END)
+        self.file_size = fileobj.tell()
+        self.seek(0)
+
+    def __len__(self):
+        return len(self.head) + self.file_size + len(self.tail)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        """Only rewinding is supported, so a failed send can be retried"""
+        if offset != 0 or whence != os.SEEK_SET:
+            raise OSError("MultipartStream can only seek back to the start")
+        self.fileobj.seek(0)
+        self.parts = [self.head, None, self.tail]
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.chunk_size
+        while self.parts:
+            part = self.parts[0]
+            if part is None:
+                data = self.fileobj.read(min(size, self.chunk_size))
+                if data:
+                    return data
+                self.parts.pop(0)
+                continue
+            if part:
+                self.parts[0] = part[size:]
+                return part[:size]
+            self.parts.pop(0)
+        return b""
+
+    def __iter__(self):
+        while True:
+            data = self.read(self.chunk_size)
+            if not data:
+                return
+            yield data
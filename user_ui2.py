@@ -1,12 +1,92 @@
+import os
+import sys
+import time
+
+# ========================================
+# Startup Import Profiling
+# ========================================
+# STARTUP_PROFILE=1 times every top-level import below (and lazy imports later)
+STARTUP_PROFILE = os.getenv("STARTUP_PROFILE") == "1"
+IMPORT_TIMES = {}
+
+if STARTUP_PROFILE:
+    import builtins
+
+    _real_import = builtins.__import__
+    _import_depth = [0]
+
+    def _profiling_import(name, *args, **kwargs):
+        # Only time the outermost import so nested ones aren't double counted
+        if _import_depth[0] or name in sys.modules:
+            return _real_import(name, *args, **kwargs)
+        _import_depth[0] += 1
+        started = time.perf_counter()
+        try:
+            return _real_import(name, *args, **kwargs)
+        finally:
+            _import_depth[0] -= 1
+            IMPORT_TIMES[name] = (time.perf_counter() - started) * 1000
+
+    builtins.__import__ = _profiling_import
+
 import streamlit as st
+from streamlit.errors import StreamlitAPIException
 import requests
-from langchain_core.messages import HumanMessage
 
-import time
+import uuid
+import re
+import codecs
+import csv
+import io
+import copy
+import json
+import socket
+import secrets
+import hashlib
+import importlib
+from urllib.parse import urlparse
+from datetime import datetime
+import zlib
+import sqlite3
+import tempfile
+import threading
+import weakref
+import contextlib
+import functools
+from collections import deque, OrderedDict, defaultdict
+import multiprocessing
+from concurrent.futures import (
+    ThreadPoolExecutor, ProcessPoolExecutor, TimeoutError as FutureTimeout,
+    wait as wait_futures, FIRST_COMPLETED
+)
 from dotenv import load_dotenv
-import os
-from requests.exceptions import ConnectionError, Timeout, RequestException
-from streamlit_autorefresh import st_autorefresh
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError, ConnectTimeout, Timeout, RequestException
+from urllib3.exceptions import ConnectTimeoutError
+
+if STARTUP_PROFILE:
+    builtins.__import__ = _real_import
+
+def lazy_import(name):
+    """Import a heavy or optional dependency on first use instead of at startup"""
+    module = sys.modules.get(name)
+    if module is None:
+        started = time.perf_counter()
+        module = importlib.import_module(name)
+        if STARTUP_PROFILE:
+            IMPORT_TIMES[f"lazy:{name}"] = (time.perf_counter() - started) * 1000
+    return module
+
+def report_import_profile():
+    """Print per-import cost, slowest first, and dump it to STARTUP_PROFILE_OUT"""
+    rows = sorted(IMPORT_TIMES.items(), key=lambda item: item[1], reverse=True)
+    print(f"[startup] imports: {sum(IMPORT_TIMES.values()):.1f} ms", file=sys.stderr)
+    for name, ms in rows:
+        print(f"[startup]   {ms:8.1f} ms  {name}", file=sys.stderr)
+    out_path = os.getenv("STARTUP_PROFILE_OUT")
+    if out_path:
+        with open(out_path, "w") as f:
+            json.dump(IMPORT_TIMES, f)
 
 
 # ========================================
@@ -15,54 +95,722 @@ from streamlit_autorefresh import st_autorefresh
 load_dotenv()
 API_BASE_URL = os.getenv("API_BASE_UL")  
 
+# Backend replicas (comma separated); defaults to the single API_BASE_UL.
+# Strategy "ewma" weighs latency by load, "least_outstanding" only load.
+API_BASE_URLS = [
+    url.strip().rstrip("/")
+    for url in os.getenv("API_BASE_URLS", API_BASE_URL or "").split(",") if url.strip()
+] or [API_BASE_URL]
+BACKEND_STRATEGY = os.getenv("BACKEND_STRATEGY", "ewma")
+BACKEND_HEALTH_PATH = os.getenv("BACKEND_HEALTH_PATH", "/health")
+BACKEND_HEALTH_INTERVAL = float(os.getenv("BACKEND_HEALTH_INTERVAL", 10))
+BACKEND_MAX_FAILURES = int(os.getenv("BACKEND_MAX_FAILURES", 3))
+# Send a duplicate GET to a second replica after this many ms (0 = off)
+BACKEND_HEDGE_MS = float(os.getenv("BACKEND_HEDGE_MS", 0))
+# Threads for hedged GETs, kept apart from the worker pool that may be issuing them
+BACKEND_HEDGE_WORKERS = int(os.getenv("BACKEND_HEDGE_WORKERS", 8))
+# A 503 with a JSON "detail" is the app's own answer (e.g. LLM quota), not the
+# replica turning work away; set a header the replicas add when they refuse
+# (e.g. X-Replica-Overloaded) to tell them apart by that instead
+BACKEND_REFUSAL_HEADER = os.getenv("BACKEND_REFUSAL_HEADER", "")
+
+# Fallback estimate of a full /chat generation, used until we have measured ones
+DEFAULT_CHAT_SECONDS = float(os.getenv("DEFAULT_CHAT_SECONDS", 30))
+
+# Client-side PDF pre-flight (pypdf in a worker process) before upload
+PDF_PREFLIGHT = os.getenv("PDF_PREFLIGHT", "1") == "1"
+PDF_SEND_TEXT = os.getenv("PDF_SEND_TEXT", "0") == "1"
+PDF_MIN_TEXT_CHARS = int(os.getenv("PDF_MIN_TEXT_CHARS", 20))
+PDF_PREFLIGHT_TIMEOUT = float(os.getenv("PDF_PREFLIGHT_TIMEOUT", 30))
+
+# Durable outbox for messages that could not be delivered
+OUTBOX_PATH = os.getenv("OUTBOX_PATH", "outbox.sqlite3")
+OUTBOX_BASE_BACKOFF = float(os.getenv("OUTBOX_BASE_BACKOFF", 5))
+OUTBOX_MAX_BACKOFF = float(os.getenv("OUTBOX_MAX_BACKOFF", 300))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", 8))
+# Messages that ran out of attempts are offered for retry this long, then dropped
+OUTBOX_FAILED_TTL = float(os.getenv("OUTBOX_FAILED_TTL", 7 * 86400))
+
+# Local embeddings (sentence-transformers on CPU) for the answer cache
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "all-MiniLM-L6-v2")
+ANSWER_CACHE = os.getenv("ANSWER_CACHE", "1") == "1"
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", 0.92))
+ANSWER_CACHE_MAX_PER_USER = int(os.getenv("ANSWER_CACHE_MAX_PER_USER", 200))
+ANSWER_CACHE_MAX_USERS = int(os.getenv("ANSWER_CACHE_MAX_USERS", 500))
+# Shorter questions ("and the second one?") usually lean on thread context
+ANSWER_CACHE_MIN_WORDS = int(os.getenv("ANSWER_CACHE_MIN_WORDS", 4))
+
+# Local vector search over the user's conversation history
+HISTORY_SEARCH = os.getenv("HISTORY_SEARCH", "1") == "1"
+HISTORY_INDEX_DIR = os.getenv("HISTORY_INDEX_DIR", "history_index")
+HISTORY_INDEX_MAX_USERS = int(os.getenv("HISTORY_INDEX_MAX_USERS", 200))
+HISTORY_SEARCH_TOP_K = int(os.getenv("HISTORY_SEARCH_TOP_K", 5))
+
+# Opening a thread streams only its newest N messages; older ones on demand
+HISTORY_WINDOW = int(os.getenv("HISTORY_WINDOW", 50))
+
+# Knowledge-base panel paging and bulk deletes
+DOC_PAGE_SIZE = int(os.getenv("DOC_PAGE_SIZE", 20))
+DOC_BULK_BATCH = int(os.getenv("DOC_BULK_BATCH", 50))
+
+# Local time-series store of /chat latency, bounded by age and row count
+METRICS_PATH = os.getenv("METRICS_PATH", "chat_metrics.sqlite3")
+METRICS_MAX_ROWS = int(os.getenv("METRICS_MAX_ROWS", 100_000))
+METRICS_RETENTION_DAYS = float(os.getenv("METRICS_RETENTION_DAYS", 7))
+# Usernames (comma separated) allowed to see everyone's metrics; others see their own
+METRICS_ADMINS = {name.strip() for name in os.getenv("METRICS_ADMINS", "").split(",") if name.strip()}
+
+# Max repaints per second while an answer streams in
+RENDER_FPS = float(os.getenv("RENDER_FPS", 10))
+
+# Ingestion job polling: each job is re-checked after roughly its own age
+# (2s, 4s, 8s, ...), capped, and all due jobs share one batched request
+JOB_POLL_BASE = float(os.getenv("JOB_POLL_BASE", 2))
+JOB_POLL_MAX = float(os.getenv("JOB_POLL_MAX", 30))
+JOB_MAX_AGE = float(os.getenv("JOB_MAX_AGE", 3600))
+
+# Content-hash dedup of uploads (local per-user index + backend check)
+DOC_HASH_INDEX_PATH = os.getenv("DOC_HASH_INDEX_PATH", "doc_hashes.sqlite3")
+
+# Per-session message memory: newest N messages stay uncompressed, and past
+# the byte budget the oldest ones spill to disk
+MSG_HOT_COUNT = int(os.getenv("MSG_HOT_COUNT", 20))
+MSG_COMPRESS_MIN_BYTES = int(os.getenv("MSG_COMPRESS_MIN_BYTES", 256))
+MSG_MEMORY_BUDGET = int(os.getenv("MSG_MEMORY_BUDGET", 512_000))
+
+# External session store so any replica can resume a session: "" (off),
+# "memory", "sqlite" or "redis". The server-issued sid and the key the
+# stored state is encrypted with ride in an HTTP-only cookie, written by
+# the route in serve.py (streamlit run serve.py). Without sticky sessions, give
+# every replica the same SESSION_COOKIE_SECRET (read by session_resume.py).
+SESSION_BACKEND = os.getenv("SESSION_BACKEND", "")
+SESSION_SQLITE_PATH = os.getenv("SESSION_SQLITE_PATH", "sessions.sqlite3")
+SESSION_REDIS_URL = os.getenv("SESSION_REDIS_URL", "redis://localhost:6379/0")
+SESSION_TTL = int(os.getenv("SESSION_TTL", 86400))
+
+# Page-reload resume from a signed HTTP-only cookie holding the refresh token
+# and light UI state; off without a secret. Writing the cookie needs the
+# route in serve.py (streamlit run serve.py).
+SESSION_RESUME_SECRET = os.getenv("SESSION_RESUME_SECRET", "")
+SESSION_RESUME_TTL = int(os.getenv("SESSION_RESUME_TTL", 7 * 86400))
+# Newest threads (and their titles) kept in the cookie, to stay under 4 KB
+SESSION_RESUME_MAX_THREADS = int(os.getenv("SESSION_RESUME_MAX_THREADS", 30))
+
+# Process-wide cache of read-mostly data shared by all tabs of a user
+SHARED_CACHE_TTL = float(os.getenv("SHARED_CACHE_TTL", 60))
+SHARED_CACHE_MAX_ENTRIES = int(os.getenv("SHARED_CACHE_MAX_ENTRIES", 2000))
+
+# Final responses of mutating requests kept by Idempotency-Key, so a replay
+# of a completed (or in-flight) request never reaches the backend twice
+IDEMPOTENCY_TTL = float(os.getenv("IDEMPOTENCY_TTL", 600))
+IDEMPOTENCY_MAX_ENTRIES = int(os.getenv("IDEMPOTENCY_MAX_ENTRIES", 2000))
+
+# Backend requests in flight at once, for the process and for each session.
+# Background work (prefetch, upload polls, outbox delivery) gets at most this
+# share of either and is dropped rather than queued when it can't start.
+SCHEDULER_MAX_INFLIGHT = int(os.getenv("SCHEDULER_MAX_INFLIGHT", 32))
+SCHEDULER_SESSION_INFLIGHT = int(os.getenv("SCHEDULER_SESSION_INFLIGHT", 4))
+SCHEDULER_BACKGROUND_SHARE = float(os.getenv("SCHEDULER_BACKGROUND_SHARE", 0.25))
+
+# Background prefetch of recent thread histories
+PREFETCH_THREADS = int(os.getenv("PREFETCH_THREADS", 3))
+PREFETCH_CONCURRENCY = int(os.getenv("PREFETCH_CONCURRENCY", 2))
+PREFETCH_MAX_PER_MIN = int(os.getenv("PREFETCH_MAX_PER_MIN", 10))
+PREFETCH_MAX_BYTES_PER_MIN = int(os.getenv("PREFETCH_MAX_BYTES_PER_MIN", 2_000_000))
+PREFETCH_TTL = float(os.getenv("PREFETCH_TTL", 300))
+
+# ========================================
+# Compact Message Store
+# ========================================
+_HOT, _PACKED, _SPILLED = 0, 1, 2
+
+class StoredMessage:
+    """One chat message; content is str (hot), zlib bytes (packed) or on disk"""
+    __slots__ = ("role", "data", "state", "meta")
+
+    def __init__(self, role, data, meta=None):
+        self.role = sys.intern(role)
+        self.data = data
+        self.state = _HOT
+        self.meta = meta
+
+    def nbytes(self):
+        return sys.getsizeof(self.data) if self.data is not None else 0
+
+_RECORD_BYTES = sys.getsizeof(StoredMessage("user", None))
+
+class SpillStore:
+    """Process-wide SQLite file holding messages evicted from session memory"""
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS spill ("
+            "store_id TEXT, idx INTEGER, content BLOB, "
+            "PRIMARY KEY (store_id, idx))"
+        )
+
+    def put(self, store_id, idx, blob):
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO spill VALUES (?, ?, ?)", (store_id, idx, blob)
+            )
+            self.conn.commit()
+
+    def load(self, store_id):
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT idx, content FROM spill WHERE store_id = ?", (store_id,)
+            ).fetchall()
+        return dict(rows)
+
+    def drop(self, store_id):
+        with self.lock:
+            self.conn.execute("DELETE FROM spill WHERE store_id = ?", (store_id,))
+            self.conn.commit()
+
+@st.cache_resource
+def get_spill_store():
+    fd, path = tempfile.mkstemp(prefix="msg_spill_", suffix=".sqlite3",
+                                dir=os.getenv("MSG_SPILL_DIR"))
+    os.close(fd)
+    return SpillStore(path)
+
+class MessageStore:
+    """
+    List-like replacement for msg_hist. Iterating yields plain
+    {"role", "content", ...} dicts, so rendering code is unchanged.
+    """
+
+    def __init__(self, messages=()):
+        self.store_id = str(uuid.uuid4())
+        self.records = []
+        self.memory_bytes = 0
+        self.spilled_bytes = 0
+        self.spill_cursor = 0
+        spill = get_spill_store()
+        weakref.finalize(self, spill.drop, self.store_id)
+        self.extend(messages)
+
+    def __len__(self):
+        return len(self.records)
+
+    def __iter__(self):
+        spilled = None
+        for idx, rec in enumerate(self.records):
+            if rec.state == _HOT:
+                content = rec.data
+            else:
+                if rec.state == _SPILLED:
+                    if spilled is None:
+                        spilled = get_spill_store().load(self.store_id)
+                    blob = spilled[idx]
+                else:
+                    blob = rec.data
+                content = zlib.decompress(blob).decode("utf-8")
+            msg = {"role": rec.role, "content": content}
+            if rec.meta:
+                msg.update(rec.meta)
+            yield msg
+
+    def __getitem__(self, idx):
+        return list(self)[idx]
+
+    def append(self, message):
+        extra = {k: v for k, v in message.items() if k not in ("role", "content")}
+        rec = StoredMessage(message["role"], message["content"], extra or None)
+        self.records.append(rec)
+        self.memory_bytes += rec.nbytes()
+        self._compact()
+
+    def extend(self, messages):
+        for message in messages:
+            self.append(message)
+
+    def replace(self, messages):
+        """Swap in another thread's history without allocating a new store"""
+        self.clear()
+        self.extend(messages)
+
+    def clear(self):
+        if self.spilled_bytes:
+            get_spill_store().drop(self.store_id)
+        self.records = []
+        self.memory_bytes = 0
+        self.spilled_bytes = 0
+        self.spill_cursor = 0
+
+    def _compact(self):
+        # Pack the message that just left the hot window
+        cold = len(self.records) - MSG_HOT_COUNT - 1
+        if cold >= 0:
+            rec = self.records[cold]
+            if rec.state == _HOT and len(rec.data) >= MSG_COMPRESS_MIN_BYTES:
+                self.memory_bytes -= rec.nbytes()
+                rec.data = zlib.compress(rec.data.encode("utf-8"))
+                rec.state = _PACKED
+                self.memory_bytes += rec.nbytes()
+
+        # Over budget: spill the oldest cold messages to disk
+        while self.memory_bytes > MSG_MEMORY_BUDGET and self.spill_cursor <= cold:
+            idx = self.spill_cursor
+            rec = self.records[idx]
+            blob = rec.data if rec.state == _PACKED else zlib.compress(rec.data.encode("utf-8"))
+            get_spill_store().put(self.store_id, idx, blob)
+            self.memory_bytes -= rec.nbytes()
+            self.spilled_bytes += len(blob)
+            rec.data = None
+            rec.state = _SPILLED
+            self.spill_cursor += 1
+
+    def footprint(self):
+        """Approximate bytes held in memory and on disk for this session"""
+        overhead = sys.getsizeof(self.records) + len(self.records) * _RECORD_BYTES
+        return {
+            "messages": len(self.records),
+            "memory_bytes": self.memory_bytes + overhead,
+            "spilled_bytes": self.spilled_bytes,
+        }
+
+
 # ========================================
 # Session State Initialization
 # ========================================
 
-if 'access_token' not in st.session_state:
-    st.session_state['access_token'] = None
+def session_hook(fn):
+    """
+    Run fn once per browser session instead of on every rerun. Done hooks
+    are remembered in session state; reset_session_hooks() (on logout) lets
+    them run again for the next login.
+    """
+    @functools.wraps(fn)
+    def run():
+        done = st.session_state.setdefault("_session_hooks", set())
+        if fn.__name__ not in done:
+            fn()
+            done.add(fn.__name__)
+    return run
 
-if 'refresh_token' not in st.session_state:
-    st.session_state['refresh_token'] = None
+def reset_session_hooks():
+    st.session_state["_session_hooks"] = set()
 
-if 'user_info' not in st.session_state:
-    st.session_state['user_info'] = None
+def skip_session_hook(hook):
+    """Mark a hook done without running it (its work was done another way)"""
+    st.session_state.setdefault("_session_hooks", set()).add(hook.__name__)
 
-if 'msg_hist' not in st.session_state:
-    st.session_state['msg_hist'] = []
+@session_hook
+def init_session_state():
+    """Defaults for every key the app reads; the first run of a session"""
+    if 'access_token' not in st.session_state:
+        st.session_state['access_token'] = None
 
-if 'show_upload' not in st.session_state:
-    st.session_state['show_upload'] = False
+    if 'refresh_token' not in st.session_state:
+        st.session_state['refresh_token'] = None
 
-if 'thread_titles' not in st.session_state:
-    st.session_state['thread_titles'] = {}
-    
-if "upload_job_id" not in st.session_state:
-    st.session_state["upload_job_id"] = None
+    if 'request_session' not in st.session_state:
+        # This session's key in the request scheduler
+        st.session_state['request_session'] = uuid.uuid4().hex
 
-if "upload_status" not in st.session_state:
-    st.session_state["upload_status"] = None
-    
+    if 'user_info' not in st.session_state:
+        st.session_state['user_info'] = None
 
-if "thread_id" not in st.session_state:
-    st.session_state["thread_id"] = None
+    if 'msg_hist' not in st.session_state:
+        st.session_state['msg_hist'] = MessageStore()
 
-if "chat_thread" not in st.session_state:
-    st.session_state["chat_thread"] = []
+    if 'show_upload' not in st.session_state:
+        st.session_state['show_upload'] = False
 
-if "messages" not in st.session_state:
-    st.session_state["messages"] = []
+    if 'thread_titles' not in st.session_state:
+        st.session_state['thread_titles'] = {}
 
-    
-    
-# new one
-if "rate_limited_until" not in st.session_state:
-    st.session_state["rate_limited_until"] = 0
+    if "upload_job_id" not in st.session_state:
+        st.session_state["upload_job_id"] = None
 
-if "is_generating" not in st.session_state:
-    st.session_state["is_generating"] = False
+    if "upload_status" not in st.session_state:
+        st.session_state["upload_status"] = None
+
+
+    if "thread_id" not in st.session_state:
+        st.session_state["thread_id"] = None
+
+    if "chat_thread" not in st.session_state:
+        st.session_state["chat_thread"] = []
+
+    if "messages" not in st.session_state:
+        st.session_state["messages"] = []
+
+
+
+    # new one
+    if "rate_limited_until" not in st.session_state:
+        st.session_state["rate_limited_until"] = 0
+
+    if "is_generating" not in st.session_state:
+        st.session_state["is_generating"] = False
+
+    if "active_generation" not in st.session_state:
+        st.session_state["active_generation"] = None
+
+    if "history_stream" not in st.session_state:
+        # Thread whose history the chat pane should stream in, if any
+        st.session_state["history_stream"] = None
+        st.session_state["history_more"] = False
+
+    if "pending_uploads" not in st.session_state:
+        st.session_state["pending_uploads"] = {}
+
+    if "upload_jobs" not in st.session_state:
+        st.session_state["upload_jobs"] = {}
+
+    if "dedup_stats" not in st.session_state:
+        st.session_state["dedup_stats"] = {"hits": 0, "bytes_saved": 0, "seconds_saved": 0.0}
+
+    if "gen_metrics" not in st.session_state:
+        st.session_state["gen_metrics"] = {
+            "completed": 0,
+            "cancelled": 0,
+            "llm_seconds_saved": 0.0,
+            "avg_chat_seconds": None,
+            "render_bytes": 0,
+            "render_flushes": 0,
+            "render_seconds": 0.0,
+            "duplicates_avoided": 0
+        }
+
+    if "history_prefetch" not in st.session_state:
+        st.session_state["history_prefetch"] = HistoryPrefetcher()
     
 
+
+# ========================================
+# Session Persistence
+# ========================================
+class MemorySessionBackend:
+    """Process-local store; the stand-in for single-replica runs and tests"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.data = {}
+
+    def load(self, sid):
+        with self.lock:
+            entry = self.data.get(sid)
+        if entry is None or entry[0] < time.time():
+            return None
+        return entry[1]
+
+    def save(self, sid, payload, ttl):
+        with self.lock:
+            self.data[sid] = (time.time() + ttl, payload)
+
+    def delete(self, sid):
+        with self.lock:
+            self.data.pop(sid, None)
+
+class SQLiteSessionBackend:
+    """Store on a file shared by the replicas (e.g. a mounted volume)"""
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, timeout=5)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            "sid TEXT PRIMARY KEY, payload BLOB, expires_at REAL)"
+        )
+
+    def load(self, sid):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT payload FROM sessions WHERE sid = ? AND expires_at > ?",
+                (sid, time.time())
+            ).fetchone()
+        return row[0] if row else None
+
+    def save(self, sid, payload, ttl):
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO sessions VALUES (?, ?, ?)",
+                (sid, payload, time.time() + ttl)
+            )
+            self.conn.commit()
+
+    def delete(self, sid):
+        with self.lock:
+            self.conn.execute("DELETE FROM sessions WHERE sid = ?", (sid,))
+            self.conn.commit()
+
+class RedisSessionBackend:
+    """Minimal RESP client (GET / SET EX / DEL) for any Redis-protocol server"""
+
+    def __init__(self, url):
+        parsed = urlparse(url)
+        self.address = (parsed.hostname or "localhost", parsed.port or 6379)
+        self.password = parsed.password
+        self.db = int(parsed.path.lstrip("/") or 0)
+        self.lock = threading.Lock()
+        self.sock = None
+        self.reader = None
+
+    def _connect(self):
+        self.sock = socket.create_connection(self.address, timeout=5)
+        self.reader = self.sock.makefile("rb")
+        if self.password:
+            self._send("AUTH", self.password)
+        if self.db:
+            self._send("SELECT", self.db)
+
+    def _send(self, *args):
+        parts = [f"*{len(args)}\r\n".encode()]
+        for arg in args:
+            raw = arg if isinstance(arg, bytes) else str(arg).encode()
+            parts.append(f"${len(raw)}\r\n".encode() + raw + b"\r\n")
+        self.sock.sendall(b"".join(parts))
+        return self._read_reply()
+
+    def _read_reply(self):
+        line = self.reader.readline()
+        if not line:
+            raise OSError("Redis connection closed")
+        kind, rest = line[:1], line[1:-2]
+        if kind == b"-":
+            raise RuntimeError(rest.decode())
+        if kind in (b"+", b":"):
+            return rest
+        if kind == b"$":
+            size = int(rest)
+            if size < 0:
+                return None
+            data = self.reader.read(size + 2)
+            return data[:-2]
+        raise RuntimeError(f"Unexpected Redis reply: {line!r}")
+
+    def _command(self, *args):
+        with self.lock:
+            for attempt in (1, 2):
+                try:
+                    if self.sock is None:
+                        self._connect()
+                    return self._send(*args)
+                except OSError:
+                    # Stale connection: reconnect once, then give up
+                    self.sock = None
+                    if attempt == 2:
+                        raise
+
+    def load(self, sid):
+        return self._command("GET", f"session:{sid}")
+
+    def save(self, sid, payload, ttl):
+        self._command("SET", f"session:{sid}", payload, "EX", ttl)
+
+    def delete(self, sid):
+        self._command("DEL", f"session:{sid}")
+
+@st.cache_resource
+def get_session_backend():
+    if SESSION_BACKEND == "memory":
+        return MemorySessionBackend()
+    if SESSION_BACKEND == "sqlite":
+        return SQLiteSessionBackend(SESSION_SQLITE_PATH)
+    if SESSION_BACKEND == "redis":
+        return RedisSessionBackend(SESSION_REDIS_URL)
+    return None
+
+# Keys that make up a resumable session (msg_hist is stored alongside)
+PERSISTED_KEYS = ("access_token", "refresh_token", "user_info", "thread_id",
+                  "chat_thread", "thread_titles", "upload_jobs", "pending_uploads")
+
+def session_cipher(key):
+    """Fernet for one session's stored state; the key lives only in its cookie"""
+    return lazy_import("cryptography.fernet").Fernet(key)
+
+def stage_sid_cookie(value):
+    """Have the browser set (or, with None, clear) the session-store cookie"""
+    session_resume = lazy_import("session_resume")
+    st.session_state["_sid_token"] = session_resume.stage(
+        value, SESSION_TTL, name=session_resume.SID_COOKIE_NAME
+    )
+
+@session_hook
+def restore_session():
+    """
+    On a new websocket session, pick the state back up from the store. Only
+    a cookie whose record decrypts is taken up; any other sid the client
+    sends is ignored, and a new one is issued on login.
+    """
+    if "sid" in st.query_params:
+        # Sessions used to ride in the URL; don't leave old ones in links
+        del st.query_params["sid"]
+    backend = get_session_backend()
+    if backend is None or st.session_state.get("session_sid"):
+        return
+
+    session_resume = lazy_import("session_resume")
+    fernet = lazy_import("cryptography.fernet")
+    cookie = st.context.cookies.get(session_resume.SID_COOKIE_NAME) or ""
+    sid, _, session_key = cookie.partition(".")
+    if not sid or not session_key:
+        return
+    try:
+        payload = backend.load(sid)
+        if not payload:
+            return
+        data = json.loads(zlib.decompress(session_cipher(session_key).decrypt(payload)))
+    except (OSError, RuntimeError, sqlite3.Error, ValueError, zlib.error, fernet.InvalidToken):
+        return
+
+    st.session_state["session_sid"] = sid
+    st.session_state["_session_key"] = session_key
+    for key in PERSISTED_KEYS:
+        if key in data:
+            st.session_state[key] = data[key]
+    st.session_state['msg_hist'].replace(data["msg_hist"])
+    st.session_state["_persisted_marker"] = data["marker"]
+
+def persist_session():
+    """Write the session to the store if anything resumable changed"""
+    backend = get_session_backend()
+    if backend is None or not is_authenticated():
+        return
+    sid = st.session_state.get("session_sid")
+    if not sid:
+        # First save since login: always a fresh sid and key of our own
+        sid = secrets.token_urlsafe(24)
+        key = lazy_import("cryptography.fernet").Fernet.generate_key().decode("ascii")
+        st.session_state["session_sid"] = sid
+        st.session_state["_session_key"] = key
+        st.session_state["_persisted_marker"] = None
+        stage_sid_cookie(f"{sid}.{key}")
+
+    snapshot = {key: st.session_state[key] for key in PERSISTED_KEYS}
+    # Cheap change check: the small keys plus the history length
+    marker = hashlib.sha1(
+        json.dumps([snapshot, len(st.session_state['msg_hist'])], sort_keys=True).encode()
+    ).hexdigest()
+    if marker == st.session_state.get("_persisted_marker"):
+        return
+
+    snapshot["msg_hist"] = list(st.session_state['msg_hist'])
+    snapshot["marker"] = marker
+    try:
+        payload = session_cipher(st.session_state["_session_key"]).encrypt(
+            zlib.compress(json.dumps(snapshot).encode())
+        )
+        backend.save(sid, payload, SESSION_TTL)
+        st.session_state["_persisted_marker"] = marker
+    except (OSError, RuntimeError, sqlite3.Error):
+        pass
+
+def forget_persisted_session():
+    backend = get_session_backend()
+    sid = st.session_state.get("session_sid")
+    if backend is None or not sid:
+        return
+    try:
+        backend.delete(sid)
+    except (OSError, RuntimeError, sqlite3.Error):
+        pass
+    st.session_state["session_sid"] = None
+    st.session_state["_session_key"] = None
+    st.session_state["_persisted_marker"] = None
+    stage_sid_cookie(None)
+
+def commit_staged_cookie(token):
+    """
+    Page JavaScript can't write an HTTP-only cookie, so the value is sealed
+    into an encrypted token and a hidden frame POSTs the token to serve.py,
+    which sets it.
+    """
+    session_resume = lazy_import("session_resume")
+    # Unchanged on later runs, so the frame isn't reloaded and re-posted
+    st.iframe(
+        f"<script>fetch({json.dumps(session_resume.COMMIT_PATH)}, "
+        f"{{method: 'POST', credentials: 'same-origin', body: {json.dumps(token)}}});</script>",
+        height="content", tab_index=-1
+    )
+
+def sync_sid_cookie():
+    token = st.session_state.get("_sid_token")
+    if token:
+        commit_staged_cookie(token)
+
+
+# ========================================
+# Session Resume Cookie
+# ========================================
+def resume_snapshot():
+    """What the resume cookie carries: the refresh token and light UI state"""
+    threads = st.session_state['chat_thread'][:SESSION_RESUME_MAX_THREADS]
+    titles = st.session_state['thread_titles']
+    return {
+        "refresh_token": st.session_state['refresh_token'],
+        "thread_id": st.session_state['thread_id'],
+        "chat_thread": threads,
+        "thread_titles": {tid: titles[tid] for tid in threads if tid in titles}
+    }
+
+def resume_from_cookie():
+    """
+    A reload starts a fresh session; log it back in from the resume cookie
+    with one /auth/refresh and one /auth/me to validate the new token. The
+    threads and titles come from the cookie, so load_user_data is skipped.
+    """
+    # Not a session_hook: logout resets those, but st.context.cookies keeps
+    # what the browser sent when the session opened, logout or not
+    if st.session_state.get("_resume_checked"):
+        return
+    st.session_state["_resume_checked"] = True
+    if not SESSION_RESUME_SECRET or is_authenticated():
+        return
+    session_resume = lazy_import("session_resume")
+    data = session_resume.verify(
+        st.context.cookies.get(session_resume.COOKIE_NAME), SESSION_RESUME_SECRET, SESSION_RESUME_TTL
+    )
+    if not data or not data.get("refresh_token"):
+        return
+
+    st.session_state['refresh_token'] = data["refresh_token"]
+    if not refresh_access_token():
+        st.session_state['refresh_token'] = None
+        return
+    fetch_user_info()
+    if not st.session_state['user_info']:
+        st.session_state['access_token'] = None
+        st.session_state['refresh_token'] = None
+        return
+
+    st.session_state['chat_thread'] = data["chat_thread"]
+    st.session_state['thread_titles'].update(data["thread_titles"])
+    if data["thread_id"]:
+        st.session_state['thread_id'] = data["thread_id"]
+        st.session_state['history_stream'] = data["thread_id"]
+    skip_session_hook(load_user_data)
+
+def sync_resume_cookie():
+    """
+    Keep the resume cookie in step with the session (set on login and when
+    tokens or threads change, cleared on logout).
+    """
+    if not SESSION_RESUME_SECRET:
+        return
+    session_resume = lazy_import("session_resume")
+    snapshot = resume_snapshot() if is_authenticated() else None
+    marker = hashlib.sha1(json.dumps(snapshot, sort_keys=True).encode()).hexdigest()
+
+    if "_resume_marker" not in st.session_state:
+        # A cookie sent with this session's request may need clearing
+        had_cookie = bool(st.context.cookies.get(session_resume.COOKIE_NAME))
+        st.session_state["_resume_marker"] = None if had_cookie else marker
+    if marker != st.session_state["_resume_marker"]:
+        value = session_resume.sign(snapshot, SESSION_RESUME_SECRET) if snapshot else None
+        st.session_state["_resume_token"] = session_resume.stage(value, SESSION_RESUME_TTL)
+        st.session_state["_resume_marker"] = marker
+
+    token = st.session_state.get("_resume_token")
+    if token:
+        commit_staged_cookie(token)
     
     
 #========================================
@@ -79,16 +827,24 @@ def  is_authenticated():
 
 def  logout():
     """Clear authentication state"""
+    forget_persisted_session()
     st.session_state['access_token'] = None
     st.session_state['refresh_token'] = None
     st.session_state['user_info'] = None
-    st.session_state['msg_hist'] = []
+    st.session_state['msg_hist'].clear()
     st.session_state['thread_id'] = None
+    st.session_state['history_stream'] = None
+    st.session_state['history_more'] = False
     st.session_state['chat_thread'] = []
     st.session_state['thread_titles'] = {}
     
     st.session_state["rate_limited_until"] = 0
     st.session_state["is_generating"] = False
+    st.session_state["active_generation"] = None
+    st.session_state["history_prefetch"].cancel()
+    st.session_state["history_prefetch"] = HistoryPrefetcher()
+    # The next login loads its own threads and titles
+    reset_session_hooks()
 
 
 # ========================================
@@ -105,9 +861,633 @@ def handle_api_error(response):
     except:
         return f"Error {response.status_code}: {response.text}"
 
-def safe_api_call(method, endpoint, **kwargs):
-    """Execute API call with centralized error handling"""
-    url = f"{API_BASE_URL}{endpoint}"
+@st.cache_resource
+def get_worker_pool():
+    """Process-wide thread pool for requests that must not block the script thread"""
+    return ThreadPoolExecutor(
+        max_workers=int(os.getenv("CHAT_WORKERS", 16)),
+        thread_name_prefix="api-worker"
+    )
+
+# Safe to replay on another replica; POSTs only when the caller says so (retry_safe)
+IDEMPOTENT_METHODS = ("GET", "HEAD", "OPTIONS", "PUT", "DELETE")
+MUTATING_METHODS = ("POST", "PUT", "PATCH", "DELETE")
+# Replica-side failures: count against the replica and try the next one
+# (a 503 only when replica_failed says so)
+BACKEND_RETRY_STATUSES = (502, 503, 504)
+# Never resent on a 503: it means the quota ran out, not that this replica did
+NO_FAILOVER_ON_503 = ("/chat",)
+
+class BackendPool:
+    """
+    The backend replicas with per-replica load, latency and health. Shared by
+    every session and the worker threads, so all state sits behind one lock.
+    """
+
+    def __init__(self, urls, strategy):
+        self.lock = threading.Lock()
+        self.strategy = strategy
+        self.backends = {
+            url: {
+                "url": url,
+                "healthy": True,
+                "outstanding": 0,
+                "ewma_ms": None,
+                "requests": 0,
+                "errors": 0,
+                "failures": 0,
+                "hedges": 0
+            }
+            for url in urls
+        }
+        self.hedge_executor = None
+
+    def __len__(self):
+        return len(self.backends)
+
+    def choose(self, exclude=()):
+        """Pick a replica and count the request against it (None if all excluded)"""
+        with self.lock:
+            candidates = [b for b in self.backends.values() if b["url"] not in exclude]
+            # If every replica looks down, try them anyway rather than fail fast
+            candidates = [b for b in candidates if b["healthy"]] or candidates
+            if not candidates:
+                return None
+            if self.strategy == "least_outstanding":
+                best = min(candidates, key=lambda b: (b["outstanding"], b["ewma_ms"] or 0.0))
+            else:
+                # Unmeasured replicas score 0, so each one gets tried early
+                best = min(candidates, key=lambda b: (b["ewma_ms"] or 0.0) * (b["outstanding"] + 1))
+            best["outstanding"] += 1
+            return best["url"]
+
+    def finish(self, url, seconds, ok):
+        """ok=None: the request was abandoned, only release the slot"""
+        with self.lock:
+            backend = self.backends[url]
+            backend["outstanding"] -= 1
+            if ok is None:
+                return
+            backend["requests"] += 1
+            if ok:
+                ms = seconds * 1000
+                ewma = backend["ewma_ms"]
+                backend["ewma_ms"] = ms if ewma is None else 0.8 * ewma + 0.2 * ms
+                backend["failures"] = 0
+            else:
+                backend["errors"] += 1
+                backend["failures"] += 1
+                if backend["failures"] >= BACKEND_MAX_FAILURES:
+                    backend["healthy"] = False
+
+    def count_hedge(self, url):
+        with self.lock:
+            self.backends[url]["hedges"] += 1
+
+    def check_health(self):
+        for url in list(self.backends):
+            try:
+                response = requests.get(f"{url}{BACKEND_HEALTH_PATH}", timeout=2)
+                # A 404 still proves the process is up and serving
+                healthy = response.status_code < 500
+            except RequestException:
+                healthy = False
+            with self.lock:
+                self.backends[url]["healthy"] = healthy
+                if healthy:
+                    self.backends[url]["failures"] = 0
+
+    def run_health_checks(self):
+        while True:
+            time.sleep(BACKEND_HEALTH_INTERVAL)
+            self.check_health()
+
+    def stats(self):
+        with self.lock:
+            return [dict(backend) for backend in self.backends.values()]
+
+@st.cache_resource
+def get_backend_pool():
+    pool = BackendPool(API_BASE_URLS, BACKEND_STRATEGY)
+    if len(pool) > 1 and BACKEND_HEDGE_MS > 0:
+        pool.hedge_executor = ThreadPoolExecutor(
+            max_workers=BACKEND_HEDGE_WORKERS, thread_name_prefix="api-hedge"
+        )
+    if len(pool) > 1:
+        threading.Thread(target=pool.run_health_checks, name="backend-health", daemon=True).start()
+    return pool
+
+# ========================================
+# Request Scheduler
+# ========================================
+PRIORITY_INTERACTIVE, PRIORITY_NAVIGATION, PRIORITY_BACKGROUND = 0, 1, 2
+PRIORITY_NAMES = ("interactive", "navigation", "background")
+
+class RequestScheduler:
+    """
+    Admission control for backend requests, shared by every session. A
+    request takes a slot under both the process cap and its session's cap;
+    navigation leaves one of each free for interactive requests, background
+    work stays within SCHEDULER_BACKGROUND_SHARE. Waiters start in priority
+    order (FIFO within a class), skipping any that their own session's cap
+    holds back. Background requests never wait: they are shed when they
+    can't start at once, when anything else is queued, or when their session
+    has an interactive request in flight.
+    """
+
+    def __init__(self, max_inflight, session_inflight, background_share):
+        self.max_inflight = max_inflight
+        self.session_inflight = session_inflight
+        self.background_share = background_share
+        self.cond = threading.Condition()
+        self.inflight = 0
+        self.sessions = {}      # session -> in-flight count per priority
+        self.waiting = {}       # (priority, seq) -> session
+        self.seq = 0
+        self.stats_by_priority = [
+            {"started": 0, "waited": 0, "wait_seconds": 0.0, "shed": 0} for _ in PRIORITY_NAMES
+        ]
+
+    def _limit(self, priority, cap):
+        if priority == PRIORITY_BACKGROUND:
+            return max(1, int(cap * self.background_share))
+        if priority == PRIORITY_NAVIGATION:
+            return max(1, cap - 1)
+        return cap
+
+    def _admissible(self, priority, session):
+        counts = self.sessions.get(session, (0, 0, 0))
+        return (self.inflight < self._limit(priority, self.max_inflight)
+                and sum(counts) < self._limit(priority, self.session_inflight))
+
+    def _may_start(self, ticket):
+        if not self._admissible(ticket[0], self.waiting[ticket]):
+            return False
+        return not any(other < ticket and self._admissible(other[0], session)
+                       for other, session in self.waiting.items())
+
+    def _start(self, priority, session, waited):
+        self.inflight += 1
+        self.sessions.setdefault(session, [0, 0, 0])[priority] += 1
+        stats = self.stats_by_priority[priority]
+        stats["started"] += 1
+        if waited > 0.001:
+            stats["waited"] += 1
+            stats["wait_seconds"] += waited
+
+    def try_acquire_background(self, session):
+        """Start a background request now or shed it (False)"""
+        with self.cond:
+            counts = self.sessions.get(session, (0, 0, 0))
+            if self.waiting or counts[PRIORITY_INTERACTIVE] or not self._admissible(PRIORITY_BACKGROUND, session):
+                self.stats_by_priority[PRIORITY_BACKGROUND]["shed"] += 1
+                return False
+            self._start(PRIORITY_BACKGROUND, session, 0.0)
+            return True
+
+    def acquire(self, priority, session, timeout, cancel_handle=None, on_wait=None):
+        """
+        Take a slot, waiting in line if needed. False when the request was
+        shed or cancelled while queued; raises Timeout after `timeout`.
+        """
+        if priority == PRIORITY_BACKGROUND:
+            return self.try_acquire_background(session)
+
+        started = time.time()
+        with self.cond:
+            self.seq += 1
+            ticket = (priority, self.seq)
+            self.waiting[ticket] = session
+        try:
+            while True:
+                with self.cond:
+                    if self._may_start(ticket):
+                        del self.waiting[ticket]
+                        self._start(priority, session, time.time() - started)
+                        return True
+                    self.cond.wait(0.25)
+                # Outside the lock: on_wait draws, and may end the script run
+                if cancel_handle is not None and cancel_handle.cancelled:
+                    return False
+                if time.time() - started > timeout:
+                    raise Timeout(f"No free request slot after {timeout}s")
+                if on_wait:
+                    on_wait(time.time() - started)
+        finally:
+            with self.cond:
+                if self.waiting.pop(ticket, None) is not None:
+                    # Our place in line may have held others back
+                    self.cond.notify_all()
+
+    def release(self, priority, session):
+        with self.cond:
+            self.inflight -= 1
+            counts = self.sessions[session]
+            counts[priority] -= 1
+            if not any(counts):
+                del self.sessions[session]
+            self.cond.notify_all()
+
+    @contextlib.contextmanager
+    def slot(self, priority, session, timeout, cancel_handle=None, on_wait=None):
+        """Yields whether the request may go ahead; releases its slot on exit"""
+        admitted = self.acquire(priority, session, timeout, cancel_handle, on_wait)
+        try:
+            yield admitted
+        finally:
+            if admitted:
+                self.release(priority, session)
+
+    def stats(self):
+        with self.cond:
+            return {
+                "inflight": self.inflight,
+                "queued": len(self.waiting),
+                "by_priority": {
+                    name: dict(stats) for name, stats in zip(PRIORITY_NAMES, self.stats_by_priority)
+                }
+            }
+
+@st.cache_resource
+def get_request_scheduler():
+    return RequestScheduler(SCHEDULER_MAX_INFLIGHT, SCHEDULER_SESSION_INFLIGHT,
+                            SCHEDULER_BACKGROUND_SHARE)
+
+def send_request(method, url, timeout, kwargs, cancel_handle=None, on_wait=None):
+    """
+    Issue the HTTP request. With a cancel_handle the request runs on a worker
+    thread and the script thread keeps polling, so a Stop click can interrupt
+    the run instead of waiting up to `timeout` seconds.
+    """
+    if cancel_handle is None:
+        return requests.request(method, url, timeout=timeout, **kwargs)
+
+    future = get_worker_pool().submit(
+        cancel_handle.session.request, method, url, timeout=timeout, **kwargs
+    )
+    try:
+        while True:
+            try:
+                return future.result(timeout=0.25)
+            except FutureTimeout:
+                if cancel_handle.cancelled:
+                    hand_over_to_worker(future, cancel_handle)
+                    return None
+                if on_wait:
+                    # Any st.* call here lets Streamlit deliver the Stop rerun
+                    on_wait(cancel_handle.elapsed())
+    except BaseException:
+        # A rerun interrupted the script, not the request: its response still
+        # settles the Idempotency-Key once the worker has it
+        hand_over_to_worker(future, cancel_handle)
+        raise
+
+def hand_over_to_worker(future, cancel_handle):
+    """
+    The worker outlives the caller: it settles the Idempotency-Key and gives
+    back the scheduler slot once the request has really finished.
+    """
+    key = getattr(cancel_handle, "ledger_key", None)
+    slot = getattr(cancel_handle, "slot", None)
+    cancel_handle.ledger_key = cancel_handle.slot = None
+    ledger, scheduler = get_response_ledger(), get_request_scheduler()
+
+    def settle(f):
+        if key is not None:
+            ledger.finish(key, None if f.cancelled() or f.exception() else f.result())
+        if slot is not None:
+            scheduler.release(*slot)
+    future.add_done_callback(settle)
+
+def never_sent(error):
+    """True when the connection failed before any of the request went out"""
+    if isinstance(error, ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], "reason", None) if error.args else None
+    # Covers refused connections and DNS failures (NewConnectionError)
+    return isinstance(error, ConnectionError) and isinstance(reason, ConnectTimeoutError)
+
+def replica_failed(response):
+    """502/504, or a 503 from the replica itself rather than the app behind it"""
+    if response.status_code not in BACKEND_RETRY_STATUSES:
+        return False
+    if response.status_code != 503:
+        return True
+    if BACKEND_REFUSAL_HEADER:
+        return BACKEND_REFUSAL_HEADER in response.headers
+    try:
+        body = response.json()
+    except ValueError:
+        return True
+    return not (isinstance(body, dict) and body.get("detail"))
+
+def timed_request(pool, base_url, method, endpoint, timeout, kwargs, cancel_handle=None, on_wait=None):
+    """send_request against one replica, recording its latency and errors"""
+    started = time.time()
+    # Anything but a response or a RequestException (e.g. a rerun raised from
+    # on_wait) abandons the request; the slot is released either way
+    seconds, ok = None, None
+    try:
+        response = send_request(method, f"{base_url}{endpoint}", timeout, kwargs, cancel_handle, on_wait)
+        if response is not None:
+            seconds, ok = time.time() - started, not replica_failed(response)
+        return response
+    except RequestException:
+        ok = False
+        raise
+    finally:
+        pool.finish(base_url, seconds, ok)
+
+def hedged_get(pool, base_url, endpoint, timeout, kwargs):
+    """
+    GET from one replica; if it hasn't answered within BACKEND_HEDGE_MS, ask a
+    second one too and take whichever answers first. Both run on the pool's
+    own hedge executor: this may itself be running on the worker pool (e.g. a
+    prefetch), and waiting there on tasks queued behind it could starve it.
+    """
+    primary = pool.hedge_executor.submit(timed_request, pool, base_url, "GET", endpoint, timeout, kwargs)
+    try:
+        return primary.result(timeout=BACKEND_HEDGE_MS / 1000)
+    except FutureTimeout:
+        pass
+
+    backup_url = pool.choose(exclude=(base_url,))
+    if backup_url is None:
+        return primary.result()
+    pool.count_hedge(backup_url)
+    backup = pool.hedge_executor.submit(timed_request, pool, backup_url, "GET", endpoint, timeout, kwargs)
+
+    done, pending = wait_futures((primary, backup), return_when=FIRST_COMPLETED)
+    for future in done:
+        if future.exception() is None:
+            loser = backup if future is primary else primary
+            # Its connection goes back to the pool instead of staying open
+            loser.add_done_callback(close_response)
+            return future.result()
+    # The first to finish failed; the other one is all that's left
+    for future in pending:
+        return future.result()
+    return primary.result()
+
+def close_response(future):
+    if not future.cancelled() and future.exception() is None and future.result() is not None:
+        future.result().close()
+
+def rewind_body(kwargs):
+    """
+    Seek multipart file objects and streamed bodies back to the start before
+    a resend. False when part of the body is a one-shot stream (e.g. a
+    generator) that can't be sent again.
+    """
+    parts = [value[1] if isinstance(value, tuple) else value
+             for value in (kwargs.get("files") or {}).values()]
+    parts.append(kwargs.get("data"))
+    for part in parts:
+        if hasattr(part, "seek"):
+            part.seek(0)
+        elif not (part is None or isinstance(part, (bytes, str, dict, list, tuple))):
+            return False
+    return True
+
+def backend_request(method, endpoint, timeout, kwargs, cancel_handle=None, on_wait=None,
+                    retry_safe=False):
+    """
+    Send a request to the best replica. Idempotent requests (and those the
+    caller marks retry_safe, e.g. because the backend dedupes their key) fail
+    over to the next replica on network errors and 502/504 or a 503 the
+    replica itself sent (replica_failed); the rest only when the connection
+    was never made or the replica refused with 503. NO_FAILOVER_ON_503
+    endpoints never move on a 503. Raises the last RequestException like
+    requests itself would.
+    """
+    pool = get_backend_pool()
+    idempotent = retry_safe or method.upper() in IDEMPOTENT_METHODS
+    hedge = (pool.hedge_executor is not None and method.upper() == "GET"
+             and cancel_handle is None)
+
+    tried = []
+    while True:
+        base_url = pool.choose(exclude=tried)
+        tried.append(base_url)
+        last_replica = len(tried) >= len(pool)
+        if cancel_handle is not None:
+            # So a Stop click cancels on the replica that is generating
+            cancel_handle.base_url = base_url
+        try:
+            if hedge:
+                response = hedged_get(pool, base_url, endpoint, timeout, kwargs)
+            else:
+                response = timed_request(pool, base_url, method, endpoint, timeout,
+                                         kwargs, cancel_handle, on_wait)
+        except RequestException as e:
+            if last_replica or not (idempotent or never_sent(e)) or not rewind_body(kwargs):
+                raise
+            continue
+        if response is None or last_replica or not replica_failed(response):
+            return response
+        if response.status_code == 503 and endpoint in NO_FAILOVER_ON_503:
+            return response
+        # 503: the replica turned the work away, so even a POST can move on
+        if (idempotent or response.status_code == 503) and rewind_body(kwargs):
+            response.close()
+            continue
+        return response
+
+def parse_server_timing(header):
+    """
+    Server-Timing header -> [{"name", "ms", "desc"}], e.g.
+    'retrieval;dur=12.5;desc="Vector search", llm;dur=80'
+    """
+    stages = []
+    for metric in re.findall(r'(?:[^,"]|"[^"]*")+', header or ""):
+        name, *params = [part.strip() for part in metric.split(";")]
+        if not name:
+            continue
+        stage = {"name": name, "ms": None, "desc": None}
+        for param in params:
+            key, _, value = param.partition("=")
+            value = value.strip().strip('"')
+            if key.strip() == "dur":
+                try:
+                    stage["ms"] = float(value)
+                except ValueError:
+                    pass
+            elif key.strip() == "desc":
+                stage["desc"] = value
+        stages.append(stage)
+    return stages
+
+class Trace:
+    """
+    W3C trace context for one operation (a chat turn, or a single call) and
+    the client-side spans recorded under it. Every request made with it
+    carries a traceparent naming its own span, so backend logs join up.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.trace_id = secrets.token_hex(16)
+        self.span_id = secrets.token_hex(8)
+        self.started = time.time()
+        self.spans = []
+
+    def traceparent(self, span_id):
+        return f"00-{self.trace_id}-{span_id}-01"
+
+    def add_span(self, name, started, span_id=None, **attrs):
+        self.spans.append({
+            "name": name,
+            "span_id": span_id or secrets.token_hex(8),
+            "parent_id": self.span_id,
+            "start": started,
+            "ms": (time.time() - started) * 1000,
+            **attrs
+        })
+
+    @contextlib.contextmanager
+    def span(self, name):
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.add_span(name, started)
+
+    def record_http(self, span_id, name, started, response):
+        if response is None:
+            self.add_span(name, started, span_id, status=None, server=[])
+            return
+        self.add_span(
+            name, started, span_id, status=response.status_code,
+            server=parse_server_timing(response.headers.get("Server-Timing"))
+        )
+
+    def summary(self):
+        """JSON-safe breakdown kept with the assistant message"""
+        return {
+            "trace_id": self.trace_id,
+            "total_ms": (time.time() - self.started) * 1000,
+            "spans": [
+                {key: span[key] for key in ("name", "ms", "status", "server") if key in span}
+                for span in self.spans
+            ]
+        }
+
+def format_timing(timing):
+    """One-line breakdown: client spans, and server stages under the HTTP span"""
+    parts = [f"🔬 trace {timing['trace_id'][:8]}", f"total {timing['total_ms']:.0f} ms"]
+    for span in timing["spans"]:
+        parts.append(f"{span['name']} {span['ms']:.0f} ms")
+        stages = [stage for stage in span.get("server") or [] if stage["ms"] is not None]
+        if stages:
+            server_ms = sum(stage["ms"] for stage in stages)
+            parts.extend(f"↳ {stage['name']} {stage['ms']:.0f} ms" for stage in stages)
+            parts.append(f"↳ network/queue {max(0.0, span['ms'] - server_ms):.0f} ms")
+    return " · ".join(parts)
+
+class ResponseLedger:
+    """
+    Final responses of mutating requests by (user, Idempotency-Key), shared
+    by every session in the process. Only responses below 500 are kept. A request whose key already completed
+    gets the stored response back without reaching the backend; one whose
+    key is in flight elsewhere (another tab, the outbox) waits for it.
+    """
+
+    # Not final: the same request may legitimately be sent again
+    RETRY_STATUSES = (401, 408, 409, 425, 429) + BACKEND_RETRY_STATUSES
+
+    def __init__(self, max_entries, ttl, max_body=1_000_000):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_body = max_body
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()   # key -> (stored_at, status, headers, body, elapsed)
+        self.inflight = {}             # key -> threading.Event
+
+    def claim(self, key):
+        """("stored", entry), ("wait", event) or ("owner", None); owners must finish()"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and time.time() - entry[0] <= self.ttl:
+                return "stored", entry
+            event = self.inflight.get(key)
+            if event is not None:
+                return "wait", event
+            self.inflight[key] = threading.Event()
+            return "owner", None
+
+    def finish(self, key, response):
+        final = (response is not None and response.status_code < 500
+                 and response.status_code not in self.RETRY_STATUSES
+                 and len(response.content) <= self.max_body)
+        with self.lock:
+            if final:
+                self.entries[key] = (time.time(), response.status_code, dict(response.headers),
+                                     response.content, response.elapsed)
+                self.entries.move_to_end(key)
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+            event = self.inflight.pop(key, None)
+        if event is not None:
+            event.set()
+
+@st.cache_resource
+def get_response_ledger():
+    return ResponseLedger(IDEMPOTENCY_MAX_ENTRIES, IDEMPOTENCY_TTL)
+
+def replayed_response(entry, url):
+    """A requests.Response rebuilt from a ledger entry"""
+    _, status, headers, body, elapsed = entry
+    response = requests.Response()
+    response.status_code = status
+    response.headers = requests.structures.CaseInsensitiveDict(headers)
+    response._content = body
+    response.elapsed = elapsed
+    response.url = url
+    response.replayed = True
+    return response
+
+def claim_idempotency_key(key, timeout, cancel_handle=None, on_wait=None):
+    """
+    The stored entry for key, or None once this call owns it (or was
+    cancelled). Waits while another caller has the same key in flight.
+    """
+    ledger = get_response_ledger()
+    started = time.time()
+    while True:
+        state, value = ledger.claim(key)
+        if state != "wait":
+            return value
+        value.wait(0.25)
+        if cancel_handle is not None and cancel_handle.cancelled:
+            return None
+        if time.time() - started > timeout:
+            raise Timeout(f"Request {key[3]} is still in flight elsewhere")
+        if on_wait:
+            on_wait(time.time() - started)
+
+def count_replayed(endpoint):
+    """A replayed /chat is an LLM generation the backend didn't run twice"""
+    if endpoint == "/chat":
+        metrics = st.session_state["gen_metrics"]
+        metrics["duplicates_avoided"] = metrics.get("duplicates_avoided", 0) + 1
+
+def safe_api_call(method, endpoint, cancel_handle=None, on_wait=None, quiet=False, trace=None,
+                  priority=PRIORITY_NAVIGATION, retry_safe=False, **kwargs):
+    """
+    Execute API call with centralized error handling (quiet: no st.error on
+    network failure). The request is recorded as a span of `trace`, or of a
+    trace of its own.
+
+    The request first takes a slot from the RequestScheduler at `priority`;
+    a shed background request returns None like a quiet network failure.
+
+    Mutating requests carry an Idempotency-Key (the caller's, or a new one)
+    that stays the same across the token-refresh replay and replica
+    failover. Once logged in, their final response is kept in the
+    ResponseLedger, so sending the same key again returns it instead of
+    redoing the work. The key alone doesn't make a POST safe to resend to
+    another replica; only callers whose backend dedupes it pass retry_safe.
+    """
     timeout = kwargs.pop("timeout", 120)
     
     
@@ -115,18 +1495,63 @@ def safe_api_call(method, endpoint, **kwargs):
         headers = kwargs.get("headers", {})
         headers.update(get_auth_headers())
         kwargs["headers"] = headers
-        
+
+    trace = trace or Trace(f"{method} {endpoint}")
+    span_id = secrets.token_hex(8)
+    headers = kwargs.get("headers") or {}
+    headers["traceparent"] = trace.traceparent(span_id)
+    kwargs["headers"] = headers
+    started = time.time()
+    response = None
+    scheduler = get_request_scheduler()
+    session = st.session_state.get('request_session')
+    admitted = False
+
+    ledger_key = None
+    if method.upper() in MUTATING_METHODS:
+        headers.setdefault("Idempotency-Key", str(uuid.uuid4()))
+        if is_authenticated() and not kwargs.get("stream"):
+            ledger_key = (current_user_id(), method.upper(), endpoint, headers["Idempotency-Key"])
+
     try:
-        response = requests.request(method, url, timeout=timeout, **kwargs)
+        if ledger_key is not None:
+            stored = claim_idempotency_key(ledger_key, timeout, cancel_handle, on_wait)
+            if stored is not None:
+                ledger_key = None
+                count_replayed(endpoint)
+                response = replayed_response(stored, f"{API_BASE_URLS[0]}{endpoint}")
+                return response
+            if cancel_handle is not None:
+                if cancel_handle.cancelled:
+                    return None
+                cancel_handle.ledger_key = ledger_key
+
+        admitted = scheduler.acquire(priority, session, timeout, cancel_handle, on_wait)
+        if not admitted:
+            if cancel_handle is not None and not cancel_handle.cancelled:
+                cancel_handle.shed = True
+            return None
+        if cancel_handle is not None:
+            cancel_handle.slot = (priority, session)
+        response = backend_request(method, endpoint, timeout, kwargs, cancel_handle, on_wait,
+                                   retry_safe)
+        if response is None:
+            return None
             # Handle 401 - try token refresh
         if response.status_code == 401 and  is_authenticated() and  st.session_state['refresh_token']:
             
+            if not rewind_body(kwargs):
+                # The first send consumed the body; leave the retry to the caller
+                return response
             if refresh_access_token():
-                # Retry with new token
+                # Retry with new token, same Idempotency-Key
                 headers = kwargs.get("headers", {})
                 headers.update(get_auth_headers())
                 kwargs["headers"] = headers
-                response = requests.request(method, url, timeout=timeout, **kwargs)
+                response = backend_request(method, endpoint, timeout, kwargs, cancel_handle,
+                                           on_wait, retry_safe)
+                if response is None:
+                    return None
             else:
                 logout()
                 st.error("❌ Session expired. Please login again.")
@@ -134,14 +1559,24 @@ def safe_api_call(method, endpoint, **kwargs):
             
         return response
     except ConnectionError:
-        st.error(f"❌ Could not connect to backend at {API_BASE_URL}. Is it running?")
+        if not quiet:
+            st.error(f"❌ Could not connect to backend at {', '.join(API_BASE_URLS)}. Is it running?")
         return None
     except Timeout:
-        st.error("⏳ Request timed out. The server took too long to respond.")
+        if not quiet:
+            st.error("⏳ Request timed out. The server took too long to respond.")
         return None
     except RequestException as e:
-        st.error(f"⚠️ Network error: {str(e)}")
+        if not quiet:
+            st.error(f"⚠️ Network error: {str(e)}")
         return None
+    finally:
+        # Unless send_request handed the key and slot to a worker still running it
+        if ledger_key is not None and getattr(cancel_handle, "ledger_key", ledger_key) is not None:
+            get_response_ledger().finish(ledger_key, response)
+        if admitted and getattr(cancel_handle, "slot", admitted) is not None:
+            scheduler.release(priority, session)
+        trace.record_http(span_id, f"{method} {endpoint}", started, response)
     
 # if st.session_state.get("current_job"):
 
@@ -166,53 +1601,123 @@ def safe_api_call(method, endpoint, **kwargs):
 #             st_autorefresh(interval=3000, key="upload_refresh")
 
 # ========================================
-# Upload Status Polling (CORRECT VERSION)
+# Shared Read Cache
 # ========================================
+class SharedReadCache:
+    """
+    Bounded LRU + TTL cache shared by every session in the process, keyed by
+    (user_id, key). Concurrent misses for the same key wait for one loader.
+    """
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()   # (user_id, key) -> (stored_at, value)
+        self.key_locks = {}
+        self.hits = defaultdict(int)
+        self.loads = defaultdict(int)
+
+    def lookup(self, user_id, key):
+        """(True, value) for a fresh entry, else (False, None)"""
+        with self.lock:
+            entry = self.entries.get((user_id, key))
+            if entry is None or time.time() - entry[0] > self.ttl:
+                return False, None
+            self.entries.move_to_end((user_id, key))
+            # Callers mutate what they get back (e.g. chat_thread), so hand out copies
+            return True, copy.deepcopy(entry[1])
+
+    def get(self, user_id, key, default=None):
+        found, value = self.lookup(user_id, key)
+        return value if found else default
+
+    def set(self, user_id, key, value):
+        with self.lock:
+            self.entries[(user_id, key)] = (time.time(), copy.deepcopy(value))
+            self.entries.move_to_end((user_id, key))
+            while len(self.entries) > self.max_entries:
+                evicted, _ = self.entries.popitem(last=False)
+                self.key_locks.pop(evicted, None)
+
+    def get_or_load(self, user_id, key, loader):
+        found, value = self.lookup(user_id, key)
+        if found:
+            self.hits[user_id] += 1
+            return value
+
+        with self.lock:
+            key_lock = self.key_locks.setdefault((user_id, key), threading.Lock())
+        with key_lock:
+            # Another tab may have filled it while we waited
+            found, value = self.lookup(user_id, key)
+            if found:
+                self.hits[user_id] += 1
+                return value
+            value = loader()
+            self.loads[user_id] += 1
+            if value is not None:
+                self.set(user_id, key, value)
+            return value
+
+    def merge(self, user_id, key, mapping):
+        """Write-through update of a dict-valued entry (e.g. thread titles)"""
+        with self.lock:
+            entry = self.entries.get((user_id, key))
+            current = dict(entry[1]) if entry else {}
+        current.update(mapping)
+        self.set(user_id, key, current)
+
+    def invalidate(self, user_id, key):
+        """Drop key and anything under it (e.g. "documents" -> "documents_meta:2")"""
+        with self.lock:
+            stale = [k for k in self.entries if k[0] == user_id and k[1].startswith(key)]
+            for k in stale:
+                del self.entries[k]
+
+    def stats(self, user_id):
+        return {"hits": self.hits[user_id], "backend_loads": self.loads[user_id]}
+
+@st.cache_resource
+def get_shared_cache():
+    return SharedReadCache(SHARED_CACHE_MAX_ENTRIES, SHARED_CACHE_TTL)
+
+def current_user_id():
+    info = st.session_state.get('user_info') or {}
+    return info.get("id", info.get("username"))
+
+def cached_read(key, loader, default):
+    """Serve key for the logged-in user from the shared cache, loading on miss"""
+    user_id = current_user_id()
+    if user_id is None:
+        value = loader()
+    else:
+        value = get_shared_cache().get_or_load(user_id, key, loader)
+    return default if value is None else value
 
-if st.session_state.get("current_job"):
-
-    job_id = st.session_state.current_job
-
-    status_response = safe_api_call(
-        "GET",
-        f"/documents/upload-status/{job_id}"
-    )
-
-    if status_response and status_response.status_code == 200:
-
-        status = status_response.json().get("status")
-
-        if status == "done":
-            st.success("✅ Document processing completed!")
-            del st.session_state.current_job
-            st.rerun()
-
-        elif status == "failed":
-            st.error("❌ Document processing failed.")
-            del st.session_state.current_job
-
-        elif status == "deleted":
-            st.warning("⚠️ Document was deleted.")
-            del st.session_state.current_job
-            st.rerun()
-
-        elif status == "processing":
-            st.info("⏳ Processing in background...")
-            st_autorefresh(interval=3000, key="upload_refresh")
-
-
+def invalidate_shared(key):
+    user_id = current_user_id()
+    if user_id is not None:
+        get_shared_cache().invalidate(user_id, key)
 
+def get_shared_titles():
+    user_id = current_user_id()
+    if user_id is None:
+        return {}
+    return get_shared_cache().get(user_id, "titles", {})
 
+def publish_thread_titles(titles):
+    user_id = current_user_id()
+    if user_id is not None and titles:
+        get_shared_cache().merge(user_id, "titles", titles)
 
 
-    
 def refresh_access_token():
     """Refresh access token using refresh token"""
     try:
-        response = requests.post(
-            f"{API_BASE_URL}/auth/refresh",
-            headers={"Authorization": f"Bearer {st.session_state['refresh_token']}"},
-            timeout=10
+        response = backend_request(
+            "POST", "/auth/refresh", 10,
+            {"headers": {"Authorization": f"Bearer {st.session_state['refresh_token']}"}}
         )
         if response.status_code == 200:
             data = response.json()
@@ -230,10 +1735,9 @@ def refresh_access_token():
 def register_user(username, email, password):
     """Register new user"""
     try:
-        response = requests.post(
-            f"{API_BASE_URL}/auth/register",
-            json={"username": username, "email": email, "password": password},
-            timeout=120
+        response = backend_request(
+            "POST", "/auth/register", 120,
+            {"json": {"username": username, "email": email, "password": password}}
         )
         if response.status_code == 201:
             data = response.json()
@@ -250,10 +1754,9 @@ def register_user(username, email, password):
 def login_user(username, password):
     """Login user"""
     try:
-        response = requests.post(
-            f"{API_BASE_URL}/auth/login",
-            json={"username": username, "password": password},
-            timeout=120
+        response = backend_request(
+            "POST", "/auth/login", 120,
+            {"json": {"username": username, "password": password}}
         )
         if response.status_code == 200:
             data = response.json()
@@ -266,34 +1769,287 @@ def login_user(username, password):
     except Exception as e:
         return {"success": False, "message": f"Error: {str(e)}"}
 
-def fetch_user_info():
-    """Fetch current user information"""
+def load_user_info():
     response = safe_api_call("GET", "/auth/me")
     if response and response.status_code == 200:
-        st.session_state['user_info'] = response.json()
+        return response.json()
+    return None
+
+def fetch_user_info():
+    """Fetch current user information"""
+    # The user id is not known yet, so /auth/me is keyed by the token itself
+    token_key = hashlib.sha256(st.session_state['access_token'].encode()).hexdigest()
+    info = get_shared_cache().get_or_load(f"token:{token_key}", "me", load_user_info)
+    if info:
+        st.session_state['user_info'] = info
 
 
 # ========================================
 # Thread Management
 # ========================================
 def create_new_thread():
-    response = safe_api_call("POST", "/threads/new")
+    response = safe_api_call("POST", "/threads/new", priority=PRIORITY_INTERACTIVE)
     if response and response.status_code == 200:
+        invalidate_shared("threads")
         return response.json()["thread_id"]
     return None
 
-def get_all_threads():
+def load_all_threads():
     response = safe_api_call("GET", "/threads")
     if response and response.status_code == 200:
         return response.json()["threads"]
-    return []
+    return None
+
+def get_all_threads():
+    return cached_read("threads", load_all_threads, [])
 
 def load_thread_history(thread_id):
-    response = safe_api_call("GET", f"/threads/{thread_id}/history")
+    response = safe_api_call("GET", f"/threads/{thread_id}/history", stream=True)
     if response and response.status_code == 200:
-        return response.json()["messages"]
+        with response:
+            # Decoded as it arrives, so the raw body is never held in full
+            return list(iter_json_messages(response.iter_content(chunk_size=65536)))
     return []
 
+def iter_json_messages(chunks):
+    """
+    Yield the items of {"messages": [...]} one at a time from raw byte
+    chunks. Only the undecoded remainder is buffered, roughly one message.
+    """
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder("utf-8")()
+    buf = ""
+    in_list = False
+    for chunk in chunks:
+        buf += text.decode(chunk)
+        if not in_list:
+            match = re.search(r'"messages"\s*:\s*\[', buf)
+            if match is None:
+                continue
+            buf = buf[match.end():]
+            in_list = True
+
+        while True:
+            buf = buf.lstrip().lstrip(",").lstrip()
+            if not buf:
+                break
+            if buf[0] == "]":
+                return
+            try:
+                message, end = decoder.raw_decode(buf)
+            except json.JSONDecodeError:
+                # The message is cut off; wait for the next chunk
+                break
+            yield message
+            buf = buf[end:]
+
+def stream_thread_history(thread_id, skip=0, limit=HISTORY_WINDOW):
+    """
+    Yield up to `limit` of a thread's messages newest first, after skipping
+    the `skip` newest. Backends that speak NDJSON send them in that order and
+    reading stops after the window. Others send the whole JSON document,
+    which is decoded incrementally keeping only a window-sized tail.
+    """
+    if st.session_state.get("history_ndjson", True):
+        response = safe_api_call(
+            "GET", f"/threads/{thread_id}/history", stream=True,
+            params={"order": "desc", "offset": skip, "limit": limit},
+            headers={"Accept": "application/x-ndjson"}
+        )
+        if not response or response.status_code != 200:
+            return
+        if "ndjson" in response.headers.get("Content-Type", ""):
+            with response:
+                for count, line in enumerate(response.iter_lines()):
+                    if count >= limit:
+                        return
+                    if line:
+                        yield json.loads(line)
+            return
+        # Plain JSON: nothing in it says whether the paging parameters were
+        # honoured, so ask for the whole history instead, from now on directly
+        response.close()
+        st.session_state["history_ndjson"] = False
+
+    response = safe_api_call("GET", f"/threads/{thread_id}/history", stream=True)
+    if not response or response.status_code != 200:
+        return
+
+    with response:
+        tail = deque(maxlen=skip + limit)
+        for message in iter_json_messages(response.iter_content(chunk_size=65536)):
+            tail.append(message)
+        newest_first = list(reversed(tail))
+        yield from newest_first[skip:]
+
+def render_history_window(thread_id, container):
+    """
+    Stream the newest HISTORY_WINDOW messages of a thread into the chat
+    pane as they arrive. They come newest first, so each one fills the next
+    slot up from the bottom.
+    """
+    slots = [container.empty() for _ in range(HISTORY_WINDOW)]
+    window = []
+    # One past the window tells whether older messages exist
+    for message in stream_thread_history(thread_id, limit=HISTORY_WINDOW + 1):
+        if len(window) == HISTORY_WINDOW:
+            st.session_state['history_more'] = True
+            break
+        window.append(message)
+        with slots[-len(window)].container():
+            with st.chat_message(message['role']):
+                st.markdown(message['content'])
+
+    window.reverse()
+    st.session_state['msg_hist'].replace(window)
+    st.session_state['history_stream'] = None
+    index_history(thread_id, window)
+
+def load_earlier_messages(thread_id):
+    """Prepend the next window of older messages to the open thread"""
+    loaded = list(st.session_state['msg_hist'])
+    older = list(stream_thread_history(thread_id, skip=len(loaded), limit=HISTORY_WINDOW + 1))
+    st.session_state['history_more'] = len(older) > HISTORY_WINDOW
+    older = older[:HISTORY_WINDOW]
+    older.reverse()
+    st.session_state['msg_hist'].replace(older + loaded)
+    index_history(thread_id, older)
+
+
+# ========================================
+# Thread History Prefetch
+# ========================================
+class HistoryPrefetcher:
+    """
+    Per-session cache of thread histories fetched in the background.
+    Worker threads never touch st.session_state; they only write here.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}       # thread_id -> (fetched_at, messages)
+        self.pending = {}       # thread_id -> future
+        self.window = deque()   # [timestamp, bytes] of recent prefetches
+        self.generation = 0     # bumped on cancel so late results are dropped
+        self.paused_until = 0
+        self.hits = 0
+        self.misses = 0
+
+    def _within_budget(self, now):
+        while self.window and now - self.window[0][0] > 60:
+            self.window.popleft()
+        used_bytes = sum(size for _, size in self.window)
+        return (
+            len(self.window) < PREFETCH_MAX_PER_MIN
+            and used_bytes < PREFETCH_MAX_BYTES_PER_MIN
+            and now >= self.paused_until
+        )
+
+    def schedule(self, thread_ids, token, session):
+        """Queue fetches for the given threads that are not cached or in flight"""
+        scheduler = get_request_scheduler()
+        now = time.time()
+        with self.lock:
+            for tid in thread_ids[:PREFETCH_THREADS]:
+                if len(self.pending) >= PREFETCH_CONCURRENCY or not self._within_budget(now):
+                    break
+                cached = self.entries.get(tid)
+                if tid in self.pending or (cached and now - cached[0] < PREFETCH_TTL):
+                    continue
+                # Reserve the slot now; the byte count is filled in on completion
+                reservation = [now, 0]
+                self.window.append(reservation)
+                self.pending[tid] = get_worker_pool().submit(
+                    self._fetch, tid, token, self.generation, scheduler, session, reservation
+                )
+
+    def _fetch(self, thread_id, token, generation, scheduler, session, reservation):
+        response = None
+        try:
+            with scheduler.slot(PRIORITY_BACKGROUND, session, 10) as admitted:
+                if admitted:
+                    response = backend_request(
+                        "GET", f"/threads/{thread_id}/history", 10,
+                        {"headers": {"Authorization": f"Bearer {token}"}}
+                    )
+        except RequestException:
+            pass
+
+        with self.lock:
+            self.pending.pop(thread_id, None)
+            if response is None:
+                return
+            # Same entry as the reservation, so a prefetch counts once
+            reservation[1] = len(response.content)
+            if generation != self.generation:
+                return
+            if response.status_code == 429:
+                retry_after = int(response.headers.get("Retry-After", 60))
+                self.paused_until = time.time() + retry_after
+            elif response.status_code == 200:
+                self.entries[thread_id] = (time.time(), response.json()["messages"])
+
+    def put(self, thread_id, messages):
+        with self.lock:
+            self.entries[thread_id] = (time.time(), messages)
+
+    def take(self, thread_id):
+        """Return cached messages (counting a hit) or None (counting a miss)"""
+        with self.lock:
+            cached = self.entries.pop(thread_id, None)
+            if cached and time.time() - cached[0] < PREFETCH_TTL:
+                self.hits += 1
+                return cached[1]
+            self.misses += 1
+            return None
+
+    def invalidate(self, thread_id):
+        with self.lock:
+            self.entries.pop(thread_id, None)
+
+    def cancel(self):
+        """Drop queued work and ignore anything still in flight"""
+        with self.lock:
+            self.generation += 1
+            for future in self.pending.values():
+                future.cancel()
+            self.pending.clear()
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else None
+
+def prefetch_recent_histories():
+    """Warm the cache for the most recent threads while the user is idle"""
+    if st.session_state.get("is_generating"):
+        return
+    if time.time() < st.session_state.get("rate_limited_until", 0):
+        return
+    recent = [
+        tid for tid in st.session_state['chat_thread']
+        if tid != st.session_state.get('thread_id')
+    ]
+    st.session_state['history_prefetch'].schedule(
+        recent, st.session_state['access_token'], st.session_state['request_session']
+    )
+
+def switch_thread(thread_id):
+    st.session_state['thread_id'] = thread_id
+    st.session_state['show_metrics'] = False
+    st.session_state['history_more'] = False
+    messages = st.session_state['history_prefetch'].take(thread_id)
+    if messages is None:
+        # Not prefetched: the chat pane streams it in, newest first
+        st.session_state['msg_hist'].clear()
+        st.session_state['history_stream'] = thread_id
+    else:
+        st.session_state['history_stream'] = None
+        st.session_state['msg_hist'].replace(messages)
+        index_history(thread_id, messages)
+    if thread_id in st.session_state['chat_thread']:
+        st.session_state['chat_thread'].remove(thread_id)
+    st.session_state['chat_thread'].insert(0, thread_id)
+
 
 # ========================================
 # Chat Functions
@@ -310,13 +2066,38 @@ def load_thread_history(thread_id):
 #     return None
 
 # new one after the slowapi
-def send_message_stream(message, thread_id):
+def send_message_stream(message, thread_id, handle=None, on_wait=None, quiet=False, trace=None,
+                        priority=PRIORITY_INTERACTIVE):
+    headers = {}
+    if handle:
+        # Same key on every retry, so the backend answers a message at most once
+        headers = {"X-Request-ID": handle.request_id, "Idempotency-Key": handle.request_id}
+    started = time.time()
     response = safe_api_call(
         "POST",
         "/chat",
         json={"message": message, "thread_id": thread_id},
-        timeout=120
+        headers=headers,
+        timeout=120,
+        cancel_handle=handle,
+        on_wait=on_wait,
+        quiet=quiet,
+        trace=trace,
+        priority=priority,
+        # The backend answers each key at most once, so a resend can't double a turn
+        retry_safe=handle is not None
     )
+    result = parse_chat_response(response, handle)
+    if not (getattr(response, "replayed", False) or result.get("type") == "shed"):
+        record_chat_metrics(started, response, result)
+    return result
+
+def parse_chat_response(response, handle):
+    if handle is not None and handle.cancelled:
+        return {"ok": False, "type": "cancelled"}
+
+    if handle is not None and handle.shed:
+        return {"ok": False, "type": "shed"}
 
     if response is None:
         return {"ok": False, "type": "network"}
@@ -359,14 +2140,853 @@ def send_message_stream(message, thread_id):
 
 
 
+# ========================================
+# Answer Latency Metrics
+# ========================================
+METRIC_FIELDS = ("ts", "user_id", "outcome", "status", "latency", "ttft", "tokens", "tokens_per_s", "cooldown")
+
+class ChatMetricsStore:
+    """
+    Process-wide time series of /chat requests on local disk. Rows older
+    than the retention or past the row cap are pruned as new ones arrive.
+    """
+
+    def __init__(self, path, max_rows, retention):
+        self.lock = threading.Lock()
+        self.max_rows = max_rows
+        self.retention = retention
+        self.inserts = 0
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS chat_metrics ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, ts REAL, user_id TEXT, outcome TEXT, "
+            "status INTEGER, latency REAL, ttft REAL, tokens INTEGER, tokens_per_s REAL, cooldown REAL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS chat_metrics_ts ON chat_metrics (ts)")
+
+    def record(self, row):
+        with self.lock:
+            self.conn.execute(
+                f"INSERT INTO chat_metrics ({', '.join(METRIC_FIELDS)}) "
+                f"VALUES ({', '.join('?' * len(METRIC_FIELDS))})",
+                [row[field] for field in METRIC_FIELDS]
+            )
+            self.inserts += 1
+            # Prune in batches rather than on every insert
+            if self.inserts % 100 == 1:
+                self.conn.execute(
+                    "DELETE FROM chat_metrics WHERE ts < ? OR id <= (SELECT MAX(id) FROM chat_metrics) - ?",
+                    (time.time() - self.retention, self.max_rows)
+                )
+            self.conn.commit()
+
+    def query(self, since, user_id=None):
+        sql = f"SELECT {', '.join(METRIC_FIELDS)} FROM chat_metrics WHERE ts >= ?"
+        args = [since]
+        if user_id is not None:
+            sql += " AND user_id = ?"
+            args.append(str(user_id))
+        with self.lock:
+            rows = self.conn.execute(sql + " ORDER BY ts", args).fetchall()
+        return [dict(zip(METRIC_FIELDS, row)) for row in rows]
+
+@st.cache_resource
+def get_chat_metrics():
+    return ChatMetricsStore(METRICS_PATH, METRICS_MAX_ROWS, METRICS_RETENTION_DAYS * 86400)
+
+def count_tokens(text):
+    """Rough token count (words and punctuation); no tokenizer on the client"""
+    return len(re.findall(r"\w+|[^\w\s]", text))
+
+def record_chat_metrics(started, response, result):
+    """
+    /chat answers in one piece, so time-to-first-token is measured as the
+    time until the response headers arrive.
+    """
+    latency = time.time() - started
+    row = dict.fromkeys(METRIC_FIELDS)
+    row.update(
+        ts=started,
+        user_id=str(current_user_id()),
+        outcome="ok" if result["ok"] else result["type"],
+        status=response.status_code if response is not None else None,
+        latency=latency,
+        cooldown=result.get("retry_after")
+    )
+    if response is not None:
+        row["ttft"] = response.elapsed.total_seconds()
+    if result["ok"]:
+        row["tokens"] = count_tokens(result["reply"])
+        row["tokens_per_s"] = row["tokens"] / latency if latency > 0 else None
+    get_chat_metrics().record(row)
+
+def percentile(values, q):
+    values = sorted(v for v in values if v is not None)
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+def summarize_chat_metrics(rows):
+    total = len(rows)
+    def rate(pred):
+        return sum(1 for row in rows if pred(row)) / total if total else 0.0
+    return {
+        "requests": total,
+        "p50_latency": percentile([row["latency"] for row in rows], 0.5),
+        "p95_latency": percentile([row["latency"] for row in rows], 0.95),
+        "p50_ttft": percentile([row["ttft"] for row in rows], 0.5),
+        "p50_tokens_per_s": percentile([row["tokens_per_s"] for row in rows], 0.5),
+        "error_rate": rate(lambda row: row["outcome"] not in ("ok", "cancelled")),
+        "rate_limited": rate(lambda row: row["status"] == 429),
+        "unavailable": rate(lambda row: row["status"] == 503),
+        "cooldown_seconds": sum(row["cooldown"] or 0 for row in rows),
+    }
+
+def metrics_csv(rows):
+    out = io.StringIO()
+    writer = csv.DictWriter(out, fieldnames=METRIC_FIELDS)
+    writer.writeheader()
+    writer.writerows(rows)
+    return out.getvalue()
+
+
+# ========================================
+# Cancellable Generation
+# ========================================
+class CancellableAdapter(HTTPAdapter):
+    """
+    HTTPAdapter that keeps the sockets of its connections, so abort() can
+    shut down the one a worker is blocked reading. Closing the Session only
+    drops idle pooled connections, not the one in use.
+    """
+
+    def __init__(self, **kwargs):
+        self.sockets = weakref.WeakSet()
+        self.aborted = False
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        adapter = self
+
+        def tracked(pool_cls):
+            class Connection(pool_cls.ConnectionCls):
+                def connect(self):
+                    super().connect()
+                    adapter.sockets.add(self.sock)
+                    if adapter.aborted:
+                        adapter.abort()
+            return type(pool_cls.__name__, (pool_cls,), {"ConnectionCls": Connection})
+
+        self.poolmanager.pool_classes_by_scheme = {
+            scheme: tracked(pool_cls)
+            for scheme, pool_cls in self.poolmanager.pool_classes_by_scheme.items()
+        }
+
+    def abort(self):
+        """The worker's read fails at once instead of running to the timeout"""
+        self.aborted = True
+        for sock in list(self.sockets):
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+class GenerationHandle:
+    """One in-flight /chat request that a later rerun can abort"""
+
+    def __init__(self, request_id=None):
+        self.request_id = request_id or str(uuid.uuid4())
+        self.base_url = None
+        self.adapter = CancellableAdapter()
+        self.session = requests.Session()
+        self.session.mount("http://", self.adapter)
+        self.session.mount("https://", self.adapter)
+        self.started = time.time()
+        self.cancelled = False
+        # The RequestScheduler turned a background send away before it started
+        self.shed = False
+
+    def elapsed(self):
+        return time.time() - self.started
+
+    def cancel(self):
+        self.cancelled = True
+        # Breaks the connection the worker is reading; its response is discarded
+        self.adapter.abort()
+        self.session.close()
+
+def notify_backend_cancel(request_id, base_url=None):
+    """Best-effort: tell the backend to stop generating for this request"""
+    try:
+        requests.post(
+            f"{base_url or API_BASE_URLS[0]}/chat/cancel",
+            json={"request_id": request_id},
+            headers=get_auth_headers(),
+            timeout=5
+        )
+    except RequestException:
+        pass
+
+def record_generation_done(handle):
+    """Update the running average used to estimate saved LLM time"""
+    metrics = st.session_state["gen_metrics"]
+    metrics["completed"] += 1
+    elapsed = handle.elapsed()
+    avg = metrics["avg_chat_seconds"]
+    metrics["avg_chat_seconds"] = elapsed if avg is None else 0.8 * avg + 0.2 * elapsed
+
+def cancel_generation():
+    """Stop button callback: abort the request and unlock the input right away"""
+    handle = st.session_state.get("active_generation")
+    if handle is None:
+        return
+
+    handle.cancel()
+    notify_backend_cancel(handle.request_id, handle.base_url)
+
+    metrics = st.session_state["gen_metrics"]
+    expected = metrics["avg_chat_seconds"] or DEFAULT_CHAT_SECONDS
+    metrics["cancelled"] += 1
+    metrics["llm_seconds_saved"] += max(0.0, expected - handle.elapsed())
+
+    st.session_state["active_generation"] = None
+    st.session_state["is_generating"] = False
+    st.toast("⏹ Generation stopped")
+
+
+# ========================================
+# Semantic Answer Cache
+# ========================================
+class EmbedderLoader:
+    """
+    The embedding model, loaded once per process on a thread of its own. The
+    import and load can take a minute on a cold CPU box, so no script run
+    waits for it unless it asks to (a history search); work that needs the
+    model meanwhile is parked and handed to the worker pool once it's in.
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.lock = threading.Lock()
+        self.loaded = threading.Event()
+        self.model = None
+        self.started = False
+        self.deferred = []      # (fn, args) waiting for the model
+
+    def start(self):
+        with self.lock:
+            if self.started:
+                return
+            self.started = True
+        threading.Thread(target=self._load, name="embedder-load", daemon=True).start()
+
+    def _load(self):
+        try:
+            sentence_transformers = lazy_import("sentence_transformers")
+            model = sentence_transformers.SentenceTransformer(EMBEDDING_MODEL, device="cpu")
+        except Exception:
+            model = None
+        with self.lock:
+            self.model = model
+            deferred, self.deferred = self.deferred, []
+            self.loaded.set()
+        if model is not None:
+            for fn, args in deferred:
+                self.pool.submit(fn, *args, model)
+
+    def get(self, wait):
+        """The model; None if unavailable or, without wait, still loading"""
+        self.start()
+        if wait:
+            self.loaded.wait()
+        return self.model
+
+    def submit(self, fn, *args):
+        """Run fn(*args, model) on the pool once the model is in; dropped without one"""
+        self.start()
+        with self.lock:
+            if not self.loaded.is_set():
+                self.deferred.append((fn, args))
+                return
+            model = self.model
+        if model is not None:
+            self.pool.submit(fn, *args, model)
+
+@st.cache_resource
+def get_embedder_loader():
+    return EmbedderLoader(get_worker_pool())
+
+def embed_texts(texts, wait=True):
+    """
+    Unit-length embeddings (so dot product = cosine), or None without a
+    model. With wait=False, also None while the model is still loading.
+    """
+    model = get_embedder_loader().get(wait)
+    if model is None:
+        return None
+    return model.encode(list(texts), normalize_embeddings=True, convert_to_numpy=True)
+
+class AnswerCache:
+    """
+    Per-user answers keyed by question embedding and valid for one
+    knowledge-base fingerprint. A brute-force numpy cosine scan is fast
+    enough for a few hundred questions per user.
+    """
+
+    def __init__(self, max_per_user, max_users, threshold):
+        self.max_per_user = max_per_user
+        self.max_users = max_users
+        self.threshold = threshold
+        self.lock = threading.Lock()
+        self.users = OrderedDict()   # user_id -> bucket
+        self.hits = 0
+        self.misses = 0
+
+    def _bucket(self, user_id, fingerprint):
+        bucket = self.users.get(user_id)
+        if bucket is None or bucket["fingerprint"] != fingerprint:
+            # Documents changed: everything cached for the old set is void
+            bucket = {"fingerprint": fingerprint, "vectors": None, "answers": []}
+            self.users[user_id] = bucket
+        self.users.move_to_end(user_id)
+        while len(self.users) > self.max_users:
+            self.users.popitem(last=False)
+        return bucket
+
+    def lookup(self, user_id, fingerprint, vector):
+        np = lazy_import("numpy")
+        with self.lock:
+            bucket = self._bucket(user_id, fingerprint)
+            if bucket["vectors"] is None:
+                self.misses += 1
+                return None
+            scores = bucket["vectors"] @ vector
+            best = int(np.argmax(scores))
+            if scores[best] < self.threshold:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return bucket["answers"][best]
+
+    def add(self, user_id, fingerprint, vector, answer):
+        np = lazy_import("numpy")
+        with self.lock:
+            bucket = self._bucket(user_id, fingerprint)
+            row = vector[np.newaxis, :].astype(np.float32)
+            if bucket["vectors"] is None:
+                bucket["vectors"] = row
+            else:
+                bucket["vectors"] = np.vstack([bucket["vectors"], row])[-self.max_per_user:]
+            bucket["answers"] = (bucket["answers"] + [answer])[-self.max_per_user:]
+
+@st.cache_resource
+def get_answer_cache():
+    return AnswerCache(ANSWER_CACHE_MAX_PER_USER, ANSWER_CACHE_MAX_USERS, ANSWER_CACHE_THRESHOLD)
+
+def kb_fingerprint():
+    return hashlib.sha256(json.dumps(sorted(get_documents())).encode()).hexdigest()
+
+def lookup_cached_answer(question):
+    """(cached answer or None, question vector or None)"""
+    user_id = current_user_id()
+    if not ANSWER_CACHE or user_id is None or len(question.split()) < ANSWER_CACHE_MIN_WORDS:
+        return None, None
+    # A chat turn never waits for the model; until it's loaded, every lookup misses
+    vectors = embed_texts([question], wait=False)
+    if vectors is None:
+        return None, None
+    return get_answer_cache().lookup(user_id, kb_fingerprint(), vectors[0]), vectors[0]
+
+def remember_answer(question, vector, answer):
+    user_id = current_user_id()
+    if not ANSWER_CACHE or user_id is None or len(question.split()) < ANSWER_CACHE_MIN_WORDS:
+        return
+    if vector is not None:
+        get_answer_cache().add(user_id, kb_fingerprint(), vector, answer)
+    else:
+        # Asked while the model was loading: embed the question once it's in
+        get_embedder_loader().submit(
+            embed_and_remember, get_answer_cache(), user_id, kb_fingerprint(), question, answer
+        )
+
+def embed_and_remember(cache, user_id, fingerprint, question, answer, model):
+    vector = model.encode([question], normalize_embeddings=True, convert_to_numpy=True)[0]
+    cache.add(user_id, fingerprint, vector, answer)
+
+
+# ========================================
+# Conversation History Search
+# ========================================
+class ConversationIndex:
+    """
+    One user's message embeddings plus the thread each came from, appended
+    to <prefix>.f32 (raw float32 rows) and <prefix>.jsonl (a {"dim"} header,
+    then one line per row). Messages are keyed by thread and content hash,
+    so re-indexing a loaded history only embeds what is new.
+    """
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.lock = threading.Lock()        # in-memory state; search holds it briefly
+        self.file_lock = threading.Lock()   # appends, in the order rows were added
+        self.vectors = None
+        self.meta = []
+        self.keys = set()
+        self._load()
+
+    def _load(self):
+        np = lazy_import("numpy")
+        meta, dim, rewrite = [], None, False
+        try:
+            with open(self.prefix + ".jsonl") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Cut short by a crash mid-append
+                        rewrite = True
+                        break
+                    if dim is None:
+                        dim = int(entry["dim"])
+                    else:
+                        meta.append(entry)
+        except (OSError, KeyError, TypeError, ValueError):
+            meta, dim = [], None
+        if dim is None:
+            meta, vectors, dim = self._load_legacy()
+            # Moved over to the append-only files
+            rewrite = dim is not None
+        else:
+            try:
+                vectors = np.fromfile(self.prefix + ".f32", dtype=np.float32)
+            except (OSError, ValueError):
+                vectors = np.zeros(0, dtype=np.float32)
+
+        if dim is None:
+            # No header: any rows on disk can't be matched to messages
+            for suffix in (".f32", ".jsonl"):
+                with contextlib.suppress(OSError):
+                    os.remove(self.prefix + suffix)
+            return
+        count = min(len(vectors) // dim, len(meta))
+        self.vectors = vectors[:count * dim].reshape(count, dim) if count else None
+        self.meta = meta[:count]
+        self.keys = {(m["thread_id"], m["key"]) for m in self.meta}
+        if rewrite or count != len(meta) or len(vectors) != count * dim:
+            # A crash between the two appends: drop the half-written rows
+            self._rewrite(dim)
+
+    def _load_legacy(self):
+        """(meta, flat vectors, dim) from the .npy/.json pair older versions wrote"""
+        np = lazy_import("numpy")
+        try:
+            with open(self.prefix + ".json") as f:
+                meta = json.load(f)
+            vectors = np.load(self.prefix + ".npy")
+        except (OSError, ValueError):
+            return [], None, None
+        return meta, vectors.astype(np.float32).ravel(), vectors.shape[1]
+
+    def _rewrite(self, dim):
+        """Replace both files with the in-memory rows, each written whole first"""
+        os.makedirs(os.path.dirname(self.prefix) or ".", exist_ok=True)
+        with self.file_lock:
+            # Vectors first: a crash between the two replaces leaves the
+            # longer .jsonl, which the next load trims back to the rows
+            with open(self.prefix + ".f32.tmp", "wb") as f:
+                if self.vectors is not None:
+                    f.write(self.vectors.tobytes())
+            os.replace(self.prefix + ".f32.tmp", self.prefix + ".f32")
+            with open(self.prefix + ".jsonl.tmp", "w") as f:
+                f.write(json.dumps({"dim": dim}) + "\n")
+                f.writelines(json.dumps(m) + "\n" for m in self.meta)
+            os.replace(self.prefix + ".jsonl.tmp", self.prefix + ".jsonl")
+
+    def _append(self, vectors, entries):
+        """Rows go on before their metadata, so a crash leaves extra rows at worst"""
+        os.makedirs(os.path.dirname(self.prefix) or ".", exist_ok=True)
+        header = not os.path.exists(self.prefix + ".jsonl")
+        with open(self.prefix + ".f32", "ab") as f:
+            f.write(vectors.tobytes())
+        with open(self.prefix + ".jsonl", "a") as f:
+            if header:
+                f.write(json.dumps({"dim": vectors.shape[1]}) + "\n")
+            f.writelines(json.dumps(m) + "\n" for m in entries)
+
+    def add(self, thread_id, messages, model):
+        """Embed and store messages not indexed yet (runs on a worker thread)"""
+        np = lazy_import("numpy")
+        fresh = {}
+        for msg in messages:
+            content = (msg.get("content") or "").strip()
+            key = hashlib.sha1(f"{msg['role']}:{content}".encode()).hexdigest()
+            if content and (thread_id, key) not in self.keys:
+                fresh[key] = (key, msg["role"], content)
+        fresh = list(fresh.values())
+        if not fresh:
+            return
+
+        vectors = model.encode([c for _, _, c in fresh], normalize_embeddings=True,
+                               convert_to_numpy=True).astype(np.float32)
+        with self.file_lock:
+            with self.lock:
+                # Another worker may have indexed some of these meanwhile
+                keep = [i for i, item in enumerate(fresh) if (thread_id, item[0]) not in self.keys]
+                if not keep:
+                    return
+                vectors = vectors[keep]
+                entries = [{"thread_id": thread_id, "key": key, "role": role, "snippet": content[:200]}
+                           for key, role, content in (fresh[i] for i in keep)]
+                self.vectors = vectors if self.vectors is None else np.vstack([self.vectors, vectors])
+                self.meta.extend(entries)
+                self.keys.update((thread_id, entry["key"]) for entry in entries)
+            # Outside self.lock, so searches don't wait on the disk
+            self._append(vectors, entries)
+
+    def search(self, query_vector, k):
+        np = lazy_import("numpy")
+        with self.lock:
+            if self.vectors is None:
+                return []
+            scores = self.vectors @ query_vector
+            top = np.argsort(-scores)[:k]
+            return [dict(self.meta[i], score=float(scores[i])) for i in top]
+
+class ConversationIndexes:
+    """
+    Process-wide, LRU-bounded map of user id -> ConversationIndex. An evicted
+    index that queued work still holds is handed out again rather than
+    opened twice, so one user's files only ever have one writer.
+    """
+
+    def __init__(self, directory, max_users):
+        self.directory = directory
+        self.max_users = max_users
+        self.lock = threading.Lock()
+        self.indexes = OrderedDict()
+        self.live = weakref.WeakValueDictionary()
+
+    def for_user(self, user_id):
+        with self.lock:
+            index = self.indexes.get(user_id) or self.live.get(user_id)
+            if index is None:
+                name = hashlib.sha256(str(user_id).encode()).hexdigest()[:32]
+                index = ConversationIndex(os.path.join(self.directory, name))
+                self.live[user_id] = index
+            self.indexes[user_id] = index
+            self.indexes.move_to_end(user_id)
+            while len(self.indexes) > self.max_users:
+                self.indexes.popitem(last=False)
+            return index
+
+@st.cache_resource
+def get_conversation_indexes():
+    return ConversationIndexes(HISTORY_INDEX_DIR, HISTORY_INDEX_MAX_USERS)
+
+def index_history(thread_id, messages):
+    """
+    Queue new messages of a thread for background indexing. Never loads the
+    model on the script thread: the work waits in the loader until it's in.
+    """
+    user_id = current_user_id()
+    if not HISTORY_SEARCH or user_id is None or not thread_id:
+        return
+    messages = list(messages)
+    if not messages:
+        return
+    index = get_conversation_indexes().for_user(user_id)
+    get_embedder_loader().submit(index.add, thread_id, messages)
+
+def search_history(query):
+    """Ranked message hits for the logged-in user, best first"""
+    user_id = current_user_id()
+    if not HISTORY_SEARCH or user_id is None:
+        return []
+    vectors = embed_texts([query])
+    if vectors is None:
+        return []
+    return get_conversation_indexes().for_user(user_id).search(vectors[0], HISTORY_SEARCH_TOP_K)
+
+
+# ========================================
+# Outbox (undelivered messages)
+# ========================================
+# Failures that go to the outbox ("queued" = held behind earlier messages).
+# Once queued, any failed attempt is retried until OUTBOX_MAX_ATTEMPTS.
+OUTBOX_RETRYABLE = ("network", "rate_limit", "quota", "queued")
+
+class Outbox:
+    """
+    Per-user queue of undelivered chat messages on local disk. Only the oldest
+    pending message of a thread is ever due, which keeps per-thread order.
+    Delivered messages are deleted; failed ones wait for the user to retry or
+    discard them, up to OUTBOX_FAILED_TTL.
+    """
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS outbox ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, user_id TEXT, thread_id TEXT, "
+            "message TEXT, idem_key TEXT UNIQUE, created_at REAL, attempts INTEGER, "
+            "next_attempt_at REAL, status TEXT)"
+        )
+        # Left behind by versions that kept delivered rows
+        self.conn.execute("DELETE FROM outbox WHERE status = 'sent'")
+        self.prune()
+
+    def prune(self):
+        with self.lock:
+            self.conn.execute(
+                "DELETE FROM outbox WHERE status = 'failed' AND created_at < ?",
+                (time.time() - OUTBOX_FAILED_TTL,)
+            )
+            self.conn.commit()
+
+    def enqueue(self, user_id, thread_id, message, idem_key, delay=0.0):
+        now = time.time()
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR IGNORE INTO outbox (user_id, thread_id, message, idem_key, "
+                "created_at, attempts, next_attempt_at, status) "
+                "VALUES (?, ?, ?, ?, ?, 0, ?, 'pending')",
+                (str(user_id), thread_id, message, idem_key, now, now + delay)
+            )
+            self.conn.commit()
+
+    def claim_next(self, user_id, lease=150.0):
+        """
+        Return the next due head-of-thread message and lease it, so another
+        tab of the same user does not send it concurrently.
+        """
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT id, thread_id, message, idem_key, attempts FROM outbox o "
+                "WHERE user_id = ? AND status = 'pending' AND next_attempt_at <= ? "
+                "AND id = (SELECT MIN(id) FROM outbox WHERE user_id = o.user_id "
+                "AND thread_id = o.thread_id AND status = 'pending') "
+                "ORDER BY id LIMIT 1", (str(user_id), now)
+            ).fetchone()
+            if row is None:
+                return None
+            self.conn.execute(
+                "UPDATE outbox SET next_attempt_at = ? WHERE id = ?", (now + lease, row[0])
+            )
+            self.conn.commit()
+        return dict(zip(("id", "thread_id", "message", "idem_key", "attempts"), row))
+
+    def mark_sent(self, item_id):
+        with self.lock:
+            self.conn.execute("DELETE FROM outbox WHERE id = ?", (item_id,))
+            self.conn.commit()
+
+    def retry_later(self, item_id, attempts, delay=None, count=True):
+        if delay is None:
+            delay = min(OUTBOX_MAX_BACKOFF, OUTBOX_BASE_BACKOFF * 2 ** attempts)
+        if count:
+            attempts += 1
+        status = "failed" if attempts >= OUTBOX_MAX_ATTEMPTS else "pending"
+        with self.lock:
+            self.conn.execute(
+                "UPDATE outbox SET attempts = ?, next_attempt_at = ?, status = ? WHERE id = ?",
+                (attempts, time.time() + delay, status, item_id)
+            )
+            self.conn.commit()
+
+    def pending(self, user_id, thread_id=None):
+        """(count, seconds until the next one is due) of pending messages"""
+        query = "SELECT COUNT(*), MIN(next_attempt_at) FROM outbox WHERE user_id = ? AND status = 'pending'"
+        args = [str(user_id)]
+        if thread_id is not None:
+            query += " AND thread_id = ?"
+            args.append(thread_id)
+        with self.lock:
+            count, next_at = self.conn.execute(query, args).fetchone()
+        return count, max(0.0, (next_at or 0) - time.time())
+
+    def failed(self, user_id):
+        """The user's messages that ran out of attempts, oldest first"""
+        self.prune()
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT id, thread_id, message, created_at FROM outbox "
+                "WHERE user_id = ? AND status = 'failed' ORDER BY id", (str(user_id),)
+            ).fetchall()
+        return [dict(zip(("id", "thread_id", "message", "created_at"), row)) for row in rows]
+
+    def retry(self, user_id, item_id):
+        """Put a failed message back in the queue with a fresh set of attempts"""
+        with self.lock:
+            self.conn.execute(
+                "UPDATE outbox SET status = 'pending', attempts = 0, next_attempt_at = ? "
+                "WHERE id = ? AND user_id = ? AND status = 'failed'",
+                (time.time(), item_id, str(user_id))
+            )
+            self.conn.commit()
+
+    def discard(self, user_id, item_id):
+        with self.lock:
+            self.conn.execute(
+                "DELETE FROM outbox WHERE id = ? AND user_id = ?", (item_id, str(user_id))
+            )
+            self.conn.commit()
+
+@st.cache_resource
+def get_outbox():
+    return Outbox(OUTBOX_PATH)
+
+def queue_undelivered(thread_id, message, idem_key, result):
+    """Put a failed message in the outbox; returns False if it should not be retried"""
+    user_id = current_user_id()
+    if user_id is None or result["type"] not in OUTBOX_RETRYABLE:
+        return False
+    delay = result.get("retry_after", OUTBOX_BASE_BACKOFF)
+    get_outbox().enqueue(user_id, thread_id, message, idem_key, delay)
+    return True
+
+def deliver_outbox():
+    """
+    Send the next due queued message while the user is idle and within
+    budget. Runs as a sidebar fragment that ticks while messages are queued.
+    """
+    user_id = current_user_id()
+    if user_id is None or st.session_state.get("is_generating"):
+        return
+    failed_outbox_panel(user_id)
+    count, due_in = get_outbox().pending(user_id)
+    if not count:
+        return
+
+    status = st.empty()
+    status.caption(f"📮 {count} message(s) waiting to send")
+
+    if time.time() < st.session_state.get("rate_limited_until", 0):
+        return
+    item = get_outbox().claim_next(user_id) if due_in == 0 else None
+    if item is None:
+        return
+
+    handle = GenerationHandle(request_id=item["idem_key"])
+    result = send_message_stream(
+        item["message"], item["thread_id"], handle=handle, quiet=True,
+        on_wait=lambda s: status.caption(f"📮 Sending queued message... {int(s)}s"),
+        priority=PRIORITY_BACKGROUND
+    )
+    if result.get("type") == "shed":
+        # Never reached the backend, so it doesn't cost an attempt
+        get_outbox().retry_later(item["id"], item["attempts"], OUTBOX_BASE_BACKOFF, count=False)
+        return
+
+    if result["ok"]:
+        get_outbox().mark_sent(item["id"])
+        if item["thread_id"] == st.session_state.get("thread_id"):
+            st.session_state['msg_hist'].append({"role": "assistant", "content": result["reply"]})
+        st.session_state['history_prefetch'].invalidate(item["thread_id"])
+        index_history(item["thread_id"], [
+            {"role": "user", "content": item["message"]},
+            {"role": "assistant", "content": result["reply"]}
+        ])
+        st.toast("📮 Queued message delivered")
+        st.rerun()
+
+    get_outbox().retry_later(item["id"], item["attempts"], result.get("retry_after"))
+    if result["type"] == "rate_limit":
+        st.session_state["rate_limited_until"] = time.time() + result["retry_after"]
+        # The cooldown banner and the locked panels live outside this fragment
+        st.rerun()
+
+
+def failed_outbox_panel(user_id):
+    """Messages that ran out of attempts, each with Retry and Discard"""
+    failed = get_outbox().failed(user_id)
+    if not failed:
+        return
+    with st.expander(f"⚠️ {len(failed)} message(s) not delivered", expanded=False):
+        for item in failed:
+            title = st.session_state['thread_titles'].get(item["thread_id"], "Untitled")
+            preview = item["message"] if len(item["message"]) <= 80 else item["message"][:77] + "..."
+            st.caption(f"{title} · {datetime.fromtimestamp(item['created_at']):%b %d %H:%M}")
+            st.text(preview)
+            col1, col2 = st.columns(2)
+            if col1.button("Retry", key=f"outbox_retry_{item['id']}", use_container_width=True):
+                get_outbox().retry(user_id, item["id"])
+                # Full rerun: the fragment only ticks while messages are pending
+                st.rerun()
+            if col2.button("Discard", key=f"outbox_discard_{item['id']}", use_container_width=True):
+                get_outbox().discard(user_id, item["id"])
+                rerun_fragment()
+
+
 def stream_text(text):
-    """Yield text word by word for streaming effect"""
+    """Yield text word by word, keeping the original whitespace and newlines"""
     if not text:
         return
-    words = text.split()
-    for word in words:
-        yield word + " "
-        time.sleep(0.05)
+    for piece in re.split(r"(\s+)", text):
+        if piece:
+            yield piece
+
+
+# ========================================
+# Streamed Reply Rendering
+# ========================================
+class MarkdownStreamRenderer:
+    """
+    Coalesces streamed tokens and repaints at most RENDER_FPS times a second.
+    Finished paragraphs are frozen into their own elements, so a repaint only
+    re-sends the tail block instead of the whole growing answer.
+    """
+
+    def __init__(self, container, fps=RENDER_FPS):
+        self.frozen_area = container.container()
+        self.tail = container.empty()
+        self.interval = 1.0 / fps
+        self.text = ""
+        self.frozen_upto = 0
+        self.last_flush = 0.0
+        self.started = time.time()
+        self.bytes_pushed = 0
+        self.flushes = 0
+
+    def feed(self, token):
+        self.text += token
+        if time.time() - self.last_flush >= self.interval:
+            self.flush()
+
+    def _push(self, element, text):
+        element.markdown(text)
+        self.bytes_pushed += len(text.encode("utf-8"))
+
+    def _freeze_finished(self):
+        pending = self.text[self.frozen_upto:]
+        cut = pending.rfind("\n\n")
+        if cut <= 0:
+            return
+        block = pending[:cut]
+        # Never split inside an open code fence
+        if block.count("```") % 2:
+            return
+        self._push(self.frozen_area, block)
+        self.frozen_upto += cut + 2
+
+    def flush(self, final=False):
+        self._freeze_finished()
+        tail = self.text[self.frozen_upto:]
+        self._push(self.tail, tail if final else tail + "▌")
+        self.last_flush = time.time()
+        self.flushes += 1
+
+    def close(self):
+        """Final repaint without the cursor; returns the full answer"""
+        self.flush(final=True)
+        return self.text
+
+    def record(self, metrics):
+        metrics["render_bytes"] += self.bytes_pushed
+        metrics["render_flushes"] += self.flushes
+        metrics["render_seconds"] += time.time() - self.started
         
 
 
@@ -374,10 +2994,194 @@ def stream_text(text):
 # Document Management
 # ========================================
 
+class DocumentHashIndex:
+    """SHA-256 -> already-ingested document, per user, kept on local disk"""
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS doc_hashes ("
+            "user_id TEXT, sha256 TEXT, filename TEXT, size INTEGER, "
+            "ingest_seconds REAL, PRIMARY KEY (user_id, sha256))"
+        )
+
+    def lookup(self, user_id, sha256):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT filename, size, ingest_seconds FROM doc_hashes "
+                "WHERE user_id = ? AND sha256 = ?", (str(user_id), sha256)
+            ).fetchone()
+        if row is None:
+            return None
+        return {"filename": row[0], "size": row[1], "ingest_seconds": row[2]}
+
+    def record(self, user_id, sha256, filename, size, ingest_seconds):
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO doc_hashes VALUES (?, ?, ?, ?, ?)",
+                (str(user_id), sha256, filename, size, ingest_seconds)
+            )
+            self.conn.commit()
+
+    def forget(self, user_id, filename=None):
+        """Drop one file's hashes, or all of the user's when filename is None"""
+        with self.lock:
+            if filename is None:
+                self.conn.execute("DELETE FROM doc_hashes WHERE user_id = ?", (str(user_id),))
+            else:
+                self.conn.execute(
+                    "DELETE FROM doc_hashes WHERE user_id = ? AND filename = ?",
+                    (str(user_id), filename)
+                )
+            self.conn.commit()
+
+@st.cache_resource
+def get_hash_index():
+    return DocumentHashIndex(DOC_HASH_INDEX_PATH)
+
+def file_sha256(file, chunk_size=1024 * 1024):
+    """Streaming SHA-256 so large files are never hashed in one buffer"""
+    digest = hashlib.sha256()
+    file.seek(0)
+    for chunk in iter(lambda: file.read(chunk_size), b""):
+        digest.update(chunk)
+    file.seek(0)
+    return digest.hexdigest()
+
+def find_indexed_document(sha256):
+    """Check the local index, then the backend, for a document with this hash"""
+    user_id = current_user_id()
+    if user_id is not None:
+        known = get_hash_index().lookup(user_id, sha256)
+        # A stale entry (file deleted elsewhere) must not block a re-upload
+        if known and known["filename"] in get_documents():
+            return known
+
+    response = safe_api_call("GET", f"/documents/exists/{sha256}", timeout=10)
+    if response is not None and response.status_code == 200:
+        data = response.json()
+        if data.get("exists"):
+            known = {
+                "filename": data.get("filename"),
+                "size": data.get("size", 0),
+                "ingest_seconds": data.get("ingest_seconds", 0.0)
+            }
+            if user_id is not None:
+                get_hash_index().record(user_id, sha256, known["filename"],
+                                        known["size"], known["ingest_seconds"])
+            return known
+    return None
+
+def finish_pending_upload(job_id, succeeded):
+    """Move a finished job's hash into the index (or drop it on failure)"""
+    pending = st.session_state["pending_uploads"].pop(job_id, None)
+    user_id = current_user_id()
+    if pending and succeeded and user_id is not None:
+        get_hash_index().record(
+            user_id, pending["sha256"], pending["filename"],
+            pending["size"], time.time() - pending["started"]
+        )
+
+@st.cache_resource
+def get_process_pool():
+    # spawn, not fork: the server process is multithreaded
+    return ProcessPoolExecutor(
+        max_workers=int(os.getenv("PDF_WORKERS", 2)),
+        mp_context=multiprocessing.get_context("spawn")
+    )
+
+def is_pdf(file):
+    return file.type == "application/pdf" or file.name.lower().endswith(".pdf")
+
+def preflight_pdf(file):
+    """
+    Parse the PDF with pypdf in a worker process (keeps the GIL free for other
+    sessions). Returns the inspection dict, or None when pre-flight is
+    unavailable and the upload should go ahead as before.
+    """
+    if not PDF_PREFLIGHT or not is_pdf(file):
+        return None
+    try:
+        preflight = lazy_import("pdf_preflight")
+        future = get_process_pool().submit(preflight.inspect_pdf, file.getvalue())
+        result = future.result(timeout=PDF_PREFLIGHT_TIMEOUT)
+    except FutureTimeout:
+        return None
+    except Exception:
+        # pypdf missing or the pool died; start a fresh pool next time
+        get_process_pool.clear()
+        return None
+    return result if result.get("ok") else None
+
+def upload_extracted_text(file, preflight):
+    """Send extracted text + page offsets; None if the backend doesn't support it"""
+    payload = {
+        "filename": file.name,
+        "text": preflight["text"],
+        "page_offsets": preflight["page_offsets"],
+        "pages": preflight["pages"]
+    }
+    response = safe_api_call("POST", "/documents/upload-text", json=payload)
+    if response is not None and response.status_code in (404, 405):
+        return None
+
+    result = parse_upload_response(response)
+    if result["success"]:
+        sent = len(json.dumps(payload).encode())
+        result["bytes_saved"] = max(0, file.size - sent)
+    return result
+
 def upload_document(file):
-    files = {"file": (file.name, file, file.type)}
-    response = safe_api_call("POST", "/documents/upload", files=files)
+    sha256 = file_sha256(file)
+    known = find_indexed_document(sha256)
+    if known:
+        stats = st.session_state["dedup_stats"]
+        stats["hits"] += 1
+        stats["bytes_saved"] += file.size
+        stats["seconds_saved"] += known["ingest_seconds"] or 0.0
+        return {
+            "success": True,
+            "duplicate": True,
+            "filename": known["filename"],
+            "bytes_saved": file.size,
+            "seconds_saved": known["ingest_seconds"] or 0.0,
+            "message": "Already indexed"
+        }
+
+    result = send_document(file, sha256)
+    if result["success"] and result.get("job_id"):
+        st.session_state["pending_uploads"][result["job_id"]] = {
+            "sha256": sha256,
+            "filename": file.name,
+            "size": file.size,
+            "started": time.time()
+        }
+    return result
+
+def send_document(file, sha256):
+    preflight = preflight_pdf(file)
+    if preflight is not None:
+        if preflight["chars"] < PDF_MIN_TEXT_CHARS:
+            if preflight["image_pages"]:
+                return {"success": False, "message": " Scanned/image-only PDF: no readable text"}
+            return {"success": False, "message": " Invalid file format or empty PDF"}
+
+        if PDF_SEND_TEXT:
+            result = upload_extracted_text(file, preflight)
+            if result is not None:
+                return result
+
+    # Streamed from the file in fixed-size chunks instead of requests'
+    # files=, which builds the whole multipart body in memory first
+    body = lazy_import("upload_stream").MultipartStream("file", file.name, file, file.type)
+    response = safe_api_call(
+        "POST", "/documents/upload", data=body,
+        headers={"X-Content-SHA256": sha256, "Content-Type": body.content_type}
+    )
+    return parse_upload_response(response)
 
+def parse_upload_response(response):
     if response is None:
         return {"success": False, "message": " Network failure"}
 
@@ -386,6 +3190,7 @@ def upload_document(file):
     #     return {"success": True, "data": response.json()}
     if response.status_code == 200:
         data = response.json()
+        invalidate_shared("documents")
 
         return {
             "success": True,
@@ -426,24 +3231,186 @@ def upload_document(file):
 
 
 
-def get_documents():
+def load_documents():
     response = safe_api_call("GET", "/documents")
     if response and response.status_code == 200:
         return response.json()["documents"]
-    return []
+    return None
+
+def get_documents():
+    return cached_read("documents", load_documents, [])
+
+def load_document_page(page):
+    response = safe_api_call(
+        "GET", "/documents/metadata",
+        params={"page": page, "page_size": DOC_PAGE_SIZE}
+    )
+    if response is not None and response.status_code in (404, 405):
+        # Older backend: page through the plain filename list instead
+        names = get_documents()
+        start = page * DOC_PAGE_SIZE
+        return {
+            "documents": [{"filename": name} for name in names[start:start + DOC_PAGE_SIZE]],
+            "total": len(names)
+        }
+    if response and response.status_code == 200:
+        return response.json()
+    return None
+
+def get_document_page(page):
+    """One page of {filename, size, chunks, ingested_at, status} plus the total"""
+    return cached_read(f"documents_meta:{page}", lambda: load_document_page(page),
+                       {"documents": [], "total": 0})
+
+def bulk_delete_documents(filenames):
+    """Delete many documents in one request"""
+    response = safe_api_call("POST", "/documents/bulk-delete", json={"filenames": filenames})
+    if response is not None and response.status_code in (404, 405):
+        return {"unsupported": True, "deleted": []}
+    if not response or response.status_code != 200:
+        return {"deleted": []}
+
+    deleted = response.json().get("deleted", filenames)
+    invalidate_shared("documents")
+    if current_user_id() is not None:
+        for filename in deleted:
+            get_hash_index().forget(current_user_id(), filename)
+    return {"deleted": deleted}
+
+def delete_documents(filenames):
+    """Bulk delete, falling back to one call per file on older backends"""
+    result = bulk_delete_documents(filenames)
+    if result.get("unsupported"):
+        result["deleted"] = [name for name in filenames if delete_document(name)]
+    return result["deleted"]
+
+def clear_documents_with_progress(filenames, progress):
+    """
+    Clear a large collection in bulk-delete batches so progress can be shown,
+    then sweep with DELETE /documents for anything not in the listing.
+    """
+    total = len(filenames)
+    for start in range(0, total, DOC_BULK_BATCH):
+        result = bulk_delete_documents(filenames[start:start + DOC_BULK_BATCH])
+        if result.get("unsupported"):
+            break
+        done = min(start + DOC_BULK_BATCH, total)
+        progress.progress(done / total, text=f"Deleted {done}/{total} documents")
+    return clear_all_documents()
+
+def format_bytes(size):
+    for unit in ("B", "KB", "MB"):
+        if size < 1024:
+            return f"{size:.0f} {unit}"
+        size /= 1024
+    return f"{size:.1f} GB"
 
 def delete_document(filename):
     response = safe_api_call("DELETE", f"/documents/{filename}")
     if response and response.status_code == 200:
+        invalidate_shared("documents")
+        if current_user_id() is not None:
+            get_hash_index().forget(current_user_id(), filename)
         return response.json()
     return None
 
 def clear_all_documents():
     response = safe_api_call("DELETE", "/documents")
     if response and response.status_code == 200:
+        invalidate_shared("documents")
+        if current_user_id() is not None:
+            get_hash_index().forget(current_user_id())
         return response.json()
     return None
 
+# ========================================
+# Upload Job Tracking
+# ========================================
+def track_upload_job(job_id, filename):
+    now = time.time()
+    st.session_state["upload_jobs"][job_id] = {
+        "filename": filename,
+        "started": now,
+        "next_poll": now + JOB_POLL_BASE
+    }
+
+def fetch_job_statuses(job_ids):
+    """
+    {job_id: status} for the given jobs, from one batched request when the
+    backend has it, else one GET per job. Jobs missing from the map are
+    unknown for now and will be asked about again.
+    """
+    if st.session_state.get("job_batch_status", True):
+        response = safe_api_call(
+            "POST", "/documents/upload-status/batch", quiet=True,
+            priority=PRIORITY_BACKGROUND, json={"job_ids": job_ids}
+        )
+        if response is not None and response.status_code in (404, 405):
+            st.session_state["job_batch_status"] = False
+        elif response is not None and response.status_code == 200:
+            jobs = response.json().get("jobs", {})
+            return {
+                job_id: (info.get("status") if isinstance(info, dict) else info)
+                for job_id, info in jobs.items()
+            }
+        else:
+            return {}
+
+    statuses = {}
+    for job_id in job_ids:
+        response = safe_api_call("GET", f"/documents/upload-status/{job_id}", quiet=True,
+                                 priority=PRIORITY_BACKGROUND)
+        if response is not None and response.status_code == 200:
+            statuses[job_id] = response.json().get("status")
+    return statuses
+
+def poll_upload_jobs():
+    """
+    Check on outstanding ingestion jobs that are due and drop the finished
+    ones. Runs on every tick of the upload fragment; ticks with nothing due
+    cost no request.
+    """
+    jobs = st.session_state["upload_jobs"]
+    if not jobs:
+        return
+
+    now = time.time()
+    # Anything due within the base interval rides along with this request
+    due = [job_id for job_id, job in jobs.items() if job["next_poll"] <= now + JOB_POLL_BASE]
+    if any(jobs[job_id]["next_poll"] <= now for job_id in due):
+        statuses = fetch_job_statuses(due)
+        refresh_docs = False
+        for job_id in due:
+            job = jobs[job_id]
+            status = statuses.get(job_id)
+            age = now - job["started"]
+
+            if status == "done":
+                st.success(f"✅ {job['filename']}: document processing completed!")
+                finish_pending_upload(job_id, succeeded=True)
+                refresh_docs = True
+            elif status == "failed":
+                st.error(f"❌ {job['filename']}: document processing failed.")
+                finish_pending_upload(job_id, succeeded=False)
+            elif status == "deleted":
+                st.warning(f"⚠️ {job['filename']}: document was deleted.")
+                finish_pending_upload(job_id, succeeded=False)
+                refresh_docs = True
+            elif age > JOB_MAX_AGE:
+                st.warning(f"⚠️ {job['filename']}: stopped waiting for processing.")
+                finish_pending_upload(job_id, succeeded=False)
+            else:
+                job["next_poll"] = now + min(JOB_POLL_MAX, max(JOB_POLL_BASE, age))
+                continue
+            del jobs[job_id]
+
+        if refresh_docs:
+            invalidate_shared("documents")
+            st.rerun()
+
+    if jobs:
+        st.info(f"⏳ Processing {len(jobs)} document(s) in background...")
+
 # ========================================
 # Thread Title Helpers
 # ========================================
@@ -460,6 +3427,7 @@ def update_thread_title_backend(thread_id, title):
     """Send thread title to backend"""
     response = safe_api_call("POST", f"/threads/{thread_id}/title", json={"title": title})
     if response and response.status_code == 200:
+        publish_thread_titles({thread_id: title})
         return True
     else:
         #st.error(f"Failed to update thread title: {handle_api_error(response)}")
@@ -505,14 +3473,36 @@ def update_thread_title_backend(thread_id, title):
 # if 'chat_thread' not in st.session_state:
 #     st.session_state['chat_thread'] = get_all_threads()
 
-# Initialize thread titles
-for tid in st.session_state['chat_thread']:
-    if tid not in st.session_state['thread_titles']:
-        messages = load_thread_history(tid)
-        if messages:
-            st.session_state['thread_titles'][tid] = generate_chat_title(messages[0]['content'])
-        else:
-            st.session_state['thread_titles'][tid] = f"Chat {str(tid)[:6]}"
+@session_hook
+def load_user_data():
+    """
+    After login (or a resumed session): the user, their threads and a title
+    for each. Runs once per login; later threads are added as they are made.
+    """
+    if not st.session_state['user_info']:
+        fetch_user_info()
+
+    if not st.session_state['thread_id']:
+        st.session_state['chat_thread'] = get_all_threads()
+    shared_titles = get_shared_titles()
+    for i, tid in enumerate(st.session_state['chat_thread']):
+        if tid not in st.session_state['thread_titles'] and tid in shared_titles:
+            st.session_state['thread_titles'][tid] = shared_titles[tid]
+        if tid not in st.session_state['thread_titles']:
+            messages = load_thread_history(tid)
+            if messages:
+                st.session_state['thread_titles'][tid] = generate_chat_title(messages[0]['content'])
+            else:
+                st.session_state['thread_titles'][tid] = f"Chat {str(tid)[:6]}"
+            # Already paid for this fetch; keep it for the most recent threads
+            if i < PREFETCH_THREADS:
+                st.session_state['history_prefetch'].put(tid, messages)
+            index_history(tid, messages)
+    publish_thread_titles({
+        tid: st.session_state['thread_titles'][tid]
+        for tid in st.session_state['chat_thread']
+        if tid not in shared_titles
+    })
 
 # def reset_chat():
 #     new_thread_id = create_new_thread()
@@ -580,7 +3570,9 @@ def reset_chat(first_user_message=None):
         return None
 
     st.session_state['thread_id'] = new_thread_id
-    st.session_state['msg_hist'] = []
+    st.session_state['msg_hist'].clear()
+    st.session_state['history_stream'] = None
+    st.session_state['history_more'] = False
 
     # DO NOT update sidebar here
     # DO NOT generate title here
@@ -1164,91 +4156,132 @@ def show_login_page():
 
 
 
-def show_chat_interface():
-    """Display authenticated chat interface"""
-    
-    # ---------------- Sidebar ----------------
-    st.sidebar.title(f"👤 {st.session_state['user_info']['username']}")
-    st.sidebar.divider()
-    
-    if st.sidebar.button('Logout', use_container_width=True, type='secondary'):
-        logout()
-        st.rerun()
-    
-    st.sidebar.divider()
-    
-    if st.sidebar.button('New Chat', use_container_width=True, type='primary'):
-        reset_chat()
+def rerun_fragment():
+    """
+    Rerun just the calling fragment. A fragment also runs as part of a full
+    run, where only a full rerun is allowed.
+    """
+    try:
+        st.rerun(scope="fragment")
+    except StreamlitAPIException:
         st.rerun()
-    
-    st.sidebar.divider()
-    
-    # Knowledge Base
+
+
+@st.fragment
+def knowledge_base_panel():
+    """Sidebar document panel; paging and deletes rerun only this fragment"""
     cooldown_active = time.time() < st.session_state.get("rate_limited_until", 0)
     docs = [] if cooldown_active else get_documents()
     kb_title = "📚 Knowledge Base 🟢" if docs else "📚 Knowledge Base"
     
-    with st.sidebar.expander(kb_title, expanded=False):
+    with st.expander(kb_title, expanded=False):
         st.caption("Your uploaded documents")
         
         if cooldown_active:
             st.info("⏳ Locked during cooldown")
         
+        dedup = st.session_state["dedup_stats"]
+        if dedup["hits"]:
+            st.caption(
+                f"♻️ {dedup['hits']} duplicate upload(s) skipped · "
+                f"{dedup['bytes_saved'] / 1024:.0f} KB · ~{dedup['seconds_saved']:.0f}s ingestion saved"
+            )
+
         if docs:
             st.success(f"✅ {len(docs)} document(s)")
-            for doc in docs:
-                col1, col2 = st.columns([3, 1])
-                with col1:
-                    st.text(f"📄 {doc}")
-                with col2:
-                    if st.button('🗑️', key=f"del_{doc}", disabled=cooldown_active):
-                        result = delete_document(doc)
-                        if result:
-                            st.success("✅ Document deleted successfully!")
-                            st.rerun()
-                        else:
-                            st.error("Failed to delete document.")
+
+            page = st.session_state.get("doc_page", 0)
+            listing = get_document_page(page)
+            if page and not listing["documents"]:
+                # Deletions emptied this page; go back to the first one
+                page = st.session_state["doc_page"] = 0
+                listing = get_document_page(page)
+
+            # A form: ticking boxes doesn't rerun, one submit = one request
+            with st.form("doc_bulk_form", border=False):
+                selected = []
+                for doc in listing["documents"]:
+                    details = [doc["filename"]]
+                    if doc.get("size") is not None:
+                        details.append(format_bytes(doc["size"]))
+                    if doc.get("chunks") is not None:
+                        details.append(f"{doc['chunks']} chunks")
+                    if doc.get("ingested_at"):
+                        details.append(str(doc["ingested_at"])[:16])
+                    if doc.get("status") and doc["status"] != "done":
+                        details.append(doc["status"])
+                    if st.checkbox(f"📄 {' · '.join(details)}", key=f"sel_{doc['filename']}"):
+                        selected.append(doc["filename"])
+                delete_selected = st.form_submit_button(
+                    '🗑️ Delete selected', disabled=cooldown_active, use_container_width=True
+                )
+
+            if delete_selected and selected:
+                with st.spinner(f"Deleting {len(selected)} document(s)..."):
+                    deleted = delete_documents(selected)
+                if deleted:
+                    st.success(f"✅ Deleted {len(deleted)} document(s)")
+                    rerun_fragment()
+                else:
+                    st.error("Failed to delete documents.")
+
+            pages = max(1, -(-listing["total"] // DOC_PAGE_SIZE))
+            if pages > 1:
+                col_prev, col_page, col_next = st.columns([1, 2, 1])
+                with col_prev:
+                    if st.button("◀", key="doc_prev", disabled=page == 0):
+                        st.session_state["doc_page"] = page - 1
+                        rerun_fragment()
+                with col_page:
+                    st.caption(f"Page {page + 1}/{pages}")
+                with col_next:
+                    if st.button("▶", key="doc_next", disabled=page + 1 >= pages):
+                        st.session_state["doc_page"] = page + 1
+                        rerun_fragment()
             
             if st.button('🗑️ Clear All', key='clear_all', type='secondary',
                          use_container_width=True, disabled=cooldown_active):
-                with st.spinner("Clearing all documents..."):
-                    result = clear_all_documents()
-                    if result:
-                        st.success("✅ All documents cleared!")
-                        st.rerun()
-                    else:
-                        st.error("Failed to clear documents.")
+                progress = st.progress(0.0, text="Clearing all documents...")
+                result = clear_documents_with_progress(docs, progress)
+                if result:
+                    st.session_state["doc_page"] = 0
+                    st.success("✅ All documents cleared!")
+                    rerun_fragment()
+                else:
+                    st.error("Failed to clear documents.")
         else:
             st.info("📭 No documents yet")
     
-    # Conversations
-    st.sidebar.subheader('💬 Conversations')
+
+@st.fragment
+def conversation_panel():
+    """Thread list and history search; typing a query reruns only this fragment"""
+    st.subheader('💬 Conversations')
     if st.session_state['chat_thread']:
         for thread_id in st.session_state['chat_thread']:
             display_name = st.session_state['thread_titles'].get(thread_id, f"Chat {str(thread_id)[:6]}")
-            if st.sidebar.button(display_name, key=thread_id, use_container_width=True):
-                st.session_state['thread_id'] = thread_id
-                messages = load_thread_history(thread_id)
-                st.session_state['msg_hist'] = messages
-                st.session_state['chat_thread'].remove(thread_id)
-                st.session_state['chat_thread'].insert(0, thread_id)
+            if st.button(display_name, key=thread_id, use_container_width=True):
+                switch_thread(thread_id)
                 st.rerun()
     else:
-        st.sidebar.caption("No previous conversations")
-    
-    # ---------------- Main Chat Area ----------------
-    st.title("💬 RAG-Enabled Chatbot")
-    
-    #Display messages container
-    chat_container = st.container()
-    with chat_container:
-        for msg in st.session_state['msg_hist']:
-            with st.chat_message(msg['role']):
-                st.markdown(msg['content'])
-    
-    
-    
-    # File upload modal
+        st.caption("No previous conversations")
+
+    if HISTORY_SEARCH:
+        query = st.text_input("🔎 Search conversations", key="history_search")
+        if query:
+            started = time.perf_counter()
+            hits = search_history(query)
+            st.caption(f"{len(hits)} hit(s) in {(time.perf_counter() - started) * 1000:.0f} ms")
+            for i, hit in enumerate(hits):
+                title = st.session_state['thread_titles'].get(hit["thread_id"], f"Chat {str(hit['thread_id'])[:6]}")
+                label = f"{title} · {hit['snippet'][:60]}"
+                if st.button(label, key=f"search_hit_{i}", use_container_width=True):
+                    switch_thread(hit["thread_id"])
+                    st.rerun()
+
+
+def upload_panel():
+    """Upload form and ingestion job status, ticking while jobs are in flight"""
     if st.session_state.get('show_upload', False):
         st.info("📤 Upload Document")
         uploaded_file = st.file_uploader("Choose file", type=['pdf', 'txt'], key='file_uploader')
@@ -1257,27 +4290,82 @@ def show_chat_interface():
             if uploaded_file and st.button('Upload', type='primary', key='upload_doc'):
                 with st.spinner('Processing...'):
                     result = upload_document(uploaded_file)
-                    if result["success"]:
-                        st.success("File uploaded! Document is being processed in background...")
-                        st.session_state.current_job = result["job_id"]
+                    if result.get("duplicate"):
+                        st.info(
+                            f"♻️ Already indexed as {result['filename']} — skipped "
+                            f"{result['bytes_saved'] / 1024:.0f} KB upload and "
+                            f"~{result['seconds_saved']:.0f}s ingestion"
+                        )
+                    elif result["success"]:
+                        track_upload_job(result["job_id"], uploaded_file.name)
+                        st.toast("✅ File uploaded! Document is being processed in background...")
+                        if result.get("bytes_saved"):
+                            st.toast(f"📉 Sent extracted text: {result['bytes_saved'] / 1024:.0f} KB less upload")
+                        # Full rerun so this fragment comes back with its status ticks on
+                        st.rerun()
                     else:
                         st.error(result["message"])
         with col2:
             if st.button('Cancel', key='cancel_upload'):
                 st.session_state['show_upload'] = False
-                st.rerun()
-    
-    # ---------------- Cooldown Handling ----------------
-    now = time.time()
+                rerun_fragment()
+
+    poll_upload_jobs()
+    persist_session()
+
+
+@st.cache_resource
+def get_cooldown_component():
+    components = lazy_import("streamlit.components.v1")
+    return components.declare_component(
+        "cooldown_countdown",
+        path=os.path.join(os.path.dirname(os.path.abspath(__file__)), "cooldown_component")
+    )
+
+def cooldown_banner():
+    """
+    Rate-limit countdown. The browser counts down and sends back one value
+    when it reaches zero, and that value is the single rerun that unlocks
+    the input. By then the sidebar has already seen the cooldown as over.
+    """
     until = st.session_state.get("rate_limited_until", 0)
-    remaining = max(0, int(until - now))
-    cooldown_active = remaining > 0
-    
-    if cooldown_active:
-        st.info(f"⏳ Cooling down... {remaining}s remaining")
-        st_autorefresh(interval=1000, key="cooldown_refresh")
-    else:
+    remaining = until - time.time()
+
+    if remaining > 0:
+        get_cooldown_component()(
+            remaining=remaining, cooldown_id=until, key="cooldown_countdown", default=None
+        )
+    elif until:
         st.session_state["rate_limited_until"] = 0
+
+
+@st.fragment
+def chat_pane():
+    """Messages, input and the generation flow; a reply reruns only this fragment"""
+    if st.session_state.get('history_more') and st.session_state.get('thread_id'):
+        if st.button("⬆️ Load earlier messages", key="load_earlier"):
+            with st.spinner("Loading earlier messages..."):
+                load_earlier_messages(st.session_state['thread_id'])
+            rerun_fragment()
+
+    #Display messages container
+    chat_container = st.container()
+    if st.session_state.get('history_stream'):
+        render_history_window(st.session_state['history_stream'], chat_container)
+        if st.session_state['history_more']:
+            # Brings up the "Load earlier" button above the messages
+            rerun_fragment()
+    else:
+        with chat_container:
+            for msg in st.session_state['msg_hist']:
+                with st.chat_message(msg['role']):
+                    st.markdown(msg['content'])
+                    if msg.get("cached"):
+                        st.caption("⚡ Answered from cache, not sent to the server")
+                    if msg.get("timing") and st.session_state.get("debug_timings"):
+                        st.caption(format_timing(msg["timing"]))
+    
+    
     
     # ---------------- Chat Input Area ----------------
     # st.markdown("""
@@ -1398,6 +4486,7 @@ def show_chat_interface():
     with col_plus:
         if st.button("➕", key="upload_btn"):
             st.session_state['show_upload'] = True
+            # The upload form is in another fragment
             st.rerun()
 
     st.markdown('</div>', unsafe_allow_html=True)
@@ -1456,6 +4545,9 @@ def show_chat_interface():
         # Lock input
         st.session_state["is_generating"] = True
 
+        # Chat traffic takes priority over background prefetch
+        st.session_state['history_prefetch'].cancel()
+
         # 1️⃣ Append user message immediately
         st.session_state['msg_hist'].append({
             "role": "user",
@@ -1468,7 +4560,8 @@ def show_chat_interface():
                 st.markdown(user_input)
 
         # ---------------- Thread Handling ----------------
-        if not st.session_state.get("thread_id"):
+        new_thread = not st.session_state.get("thread_id")
+        if new_thread:
             thread_id = create_new_thread()
             st.session_state["thread_id"] = thread_id
 
@@ -1486,25 +4579,71 @@ def show_chat_interface():
         # ---------------- STREAM AI RESPONSE ----------------
         with chat_container:
             with st.chat_message("assistant"):
+                trace = Trace("chat turn")
+                with trace.span("answer cache"):
+                    cached_answer, question_vector = lookup_cached_answer(user_input)
+                if cached_answer is None:
+                    st.button(
+                        "⏹ Stop generating",
+                        key="stop_generating",
+                        on_click=cancel_generation
+                    )
                 message_placeholder = st.empty()
-                full_response = ""
-
-                result = send_message_stream(user_input, thread_id)
 
-                if result["ok"]:
+                handle = GenerationHandle()
+                user_id = current_user_id()
+                if cached_answer is not None:
+                    # No /chat: the backend's copy of the thread won't have this turn
+                    result = {"ok": True, "reply": cached_answer, "cached": True}
+                elif user_id is not None and get_outbox().pending(user_id, thread_id)[0]:
+                    # Earlier messages of this thread are still queued; keep the order
+                    result = {"ok": False, "type": "queued"}
+                else:
+                    st.session_state["active_generation"] = handle
+                    result = send_message_stream(
+                        user_input,
+                        thread_id,
+                        handle=handle,
+                        on_wait=lambda s: message_placeholder.markdown(f"⏳ Thinking... {int(s)}s"),
+                        trace=trace
+                    )
+                    st.session_state["active_generation"] = None
+                queued = not result["ok"] and queue_undelivered(
+                    thread_id, user_input, handle.request_id, result
+                )
+
+                if result.get("cached"):
+                    message_placeholder.markdown(cached_answer)
+                    st.caption("⚡ Answered from cache, not sent to the server")
+                    st.session_state['msg_hist'].append({
+                        "role": "assistant", "content": cached_answer,
+                        "timing": trace.summary(), "cached": True
+                    })
+                    index_history(thread_id, [
+                        {"role": "user", "content": user_input},
+                        {"role": "assistant", "content": cached_answer}
+                    ])
 
-                    # IMPORTANT: reply must be generator
-                    for chunk in result["reply"]:
-                        full_response += chunk
-                        message_placeholder.markdown(full_response + "▌")
+                elif result["ok"]:
+                    record_generation_done(handle)
 
-                    message_placeholder.markdown(full_response)
+                    with trace.span("render"):
+                        renderer = MarkdownStreamRenderer(message_placeholder.container())
+                        for chunk in stream_text(result["reply"]):
+                            renderer.feed(chunk)
+                        full_response = renderer.close()
+                    renderer.record(st.session_state["gen_metrics"])
 
                     # Save final response
                     st.session_state['msg_hist'].append({
-                        "role": "assistant",
-                        "content": full_response
+                        "role": "assistant", "content": full_response, "timing": trace.summary()
                     })
+                    st.session_state['history_prefetch'].invalidate(thread_id)
+                    remember_answer(user_input, question_vector, full_response)
+                    index_history(thread_id, [
+                        {"role": "user", "content": user_input},
+                        {"role": "assistant", "content": full_response}
+                    ])
 
                 elif result["type"] == "rate_limit":
                     st.session_state["rate_limited_until"] = time.time() + result["retry_after"]
@@ -1516,15 +4655,220 @@ def show_chat_interface():
                 elif result["type"] == "quota":
                     message_placeholder.markdown(result["message"])
 
+                elif result["type"] == "queued":
+                    message_placeholder.markdown("📮 Waiting for earlier messages in this thread")
+
+                elif result["type"] == "cancelled":
+                    message_placeholder.markdown("⏹ Generation stopped")
+
                 else:
                     message_placeholder.markdown("Error occurred")
 
+                if queued:
+                    st.caption("📮 Saved to outbox — it will be sent automatically")
+                if st.session_state.get("debug_timings"):
+                    st.caption(format_timing(trace.summary()))
+
         # Unlock input
         st.session_state["is_generating"] = False
+        persist_session()
 
-        # Single rerun after streaming completes
+        # Single rerun after streaming completes; the sidebar only needs it
+        # for a new thread's title, the cooldown banner for a rate limit and
+        # the outbox fragment to start its delivery timer for a queued message
+        if new_thread or queued or result.get("type") == "rate_limit":
+            st.rerun()
+        rerun_fragment()
+
+METRIC_WINDOWS = {"Last hour": 3600, "Last 24 hours": 86400, "Last 7 days": 7 * 86400}
+LATENCY_BUCKETS = (1, 2, 5, 10, 20, 30, 60)
+
+def is_metrics_admin():
+    """Every user's metrics are for operators named in METRICS_ADMINS only"""
+    info = st.session_state.get('user_info') or {}
+    return info.get("username") in METRICS_ADMINS
+
+def show_metrics_page():
+    """What users experience from /chat: latency, first token, throughput, errors"""
+    st.title("📈 Answer Latency")
+    if st.button("← Back to chat", key="metrics_back"):
+        st.session_state["show_metrics"] = False
         st.rerun()
 
+    col_scope, col_window = st.columns(2)
+    with col_scope:
+        if is_metrics_admin():
+            scope = st.radio("Scope", ("Me", "Everyone"), horizontal=True, key="metrics_scope")
+        else:
+            scope = "Me"
+    with col_window:
+        window = st.selectbox("Window", list(METRIC_WINDOWS), key="metrics_window")
+
+    user_id = None if scope == "Everyone" else current_user_id()
+    if user_id is None and scope != "Everyone":
+        return
+    rows = get_chat_metrics().query(time.time() - METRIC_WINDOWS[window], user_id)
+    if not rows:
+        st.info("No chat requests recorded in this window yet.")
+        return
+
+    summary = summarize_chat_metrics(rows)
+    def seconds(value):
+        return "–" if value is None else f"{value:.2f}s"
+
+    cols = st.columns(4)
+    cols[0].metric("Requests", summary["requests"])
+    cols[1].metric("p50 latency", seconds(summary["p50_latency"]))
+    cols[2].metric("p95 latency", seconds(summary["p95_latency"]))
+    cols[3].metric("p50 time to first token", seconds(summary["p50_ttft"]))
+    cols = st.columns(4)
+    tokens_per_s = summary["p50_tokens_per_s"]
+    cols[0].metric("p50 tokens/s", "–" if tokens_per_s is None else f"{tokens_per_s:.1f}")
+    cols[1].metric("Error rate", f"{summary['error_rate']:.1%}")
+    cols[2].metric("429 rate", f"{summary['rate_limited']:.1%}")
+    cols[3].metric("503 rate", f"{summary['unavailable']:.1%}")
+    st.caption(f"⏳ {summary['cooldown_seconds']:.0f}s of rate-limit cooldown imposed")
+
+    st.subheader("Latency distribution")
+    labels = [f"≤{limit}s" for limit in LATENCY_BUCKETS] + [f">{LATENCY_BUCKETS[-1]}s"]
+    counts = [0] * len(labels)
+    for row in rows:
+        bucket = next((i for i, limit in enumerate(LATENCY_BUCKETS) if row["latency"] <= limit),
+                      len(LATENCY_BUCKETS))
+        counts[bucket] += 1
+    st.bar_chart({"latency": labels, "requests": counts}, x="latency", y="requests", sort=False)
+
+    st.subheader("Latency over time")
+    st.line_chart(
+        {
+            "time": [datetime.fromtimestamp(row["ts"]) for row in rows],
+            "latency (s)": [row["latency"] for row in rows],
+            "time to first token (s)": [row["ttft"] for row in rows],
+        },
+        x="time"
+    )
+
+    if scope == "Everyone":
+        st.subheader("Per user")
+        by_user = defaultdict(list)
+        for row in rows:
+            by_user[row["user_id"]].append(row)
+        st.dataframe([
+            {"user": uid, **{key: value for key, value in summarize_chat_metrics(user_rows).items()
+                            if key != "cooldown_seconds"}}
+            for uid, user_rows in by_user.items()
+        ], hide_index=True)
+
+    st.download_button(
+        "⬇️ Export CSV", metrics_csv(rows),
+        file_name=f"chat_metrics_{scope.lower()}.csv", mime="text/csv"
+    )
+
+    with st.expander("This session"):
+        metrics = st.session_state["gen_metrics"]
+        st.caption(
+            f"{metrics['completed']} answered · {metrics['cancelled']} stopped"
+            f" · ~{int(metrics['llm_seconds_saved'])}s LLM time saved"
+        )
+        if metrics.get("duplicates_avoided"):
+            st.caption(f"♻️ {metrics['duplicates_avoided']} duplicate generation(s) avoided")
+        if metrics["render_flushes"]:
+            st.caption(
+                f"Rendering: {metrics['render_flushes']} repaints"
+                f" · {metrics['render_bytes'] / 1024:.1f} KB pushed"
+                f" · {metrics['render_seconds']:.1f}s"
+            )
+
+
+def show_chat_interface():
+    """Display authenticated chat interface"""
+    
+    # ---------------- Sidebar ----------------
+    st.sidebar.title(f"👤 {st.session_state['user_info']['username']}")
+    st.sidebar.divider()
+    
+    if st.sidebar.button('Logout', use_container_width=True, type='secondary'):
+        logout()
+        st.rerun()
+    
+    st.sidebar.divider()
+    
+    if st.sidebar.button('New Chat', use_container_width=True, type='primary'):
+        reset_chat()
+        st.session_state["show_metrics"] = False
+        st.rerun()
+
+    if st.sidebar.button('📈 Answer latency', use_container_width=True):
+        st.session_state["show_metrics"] = True
+        st.rerun()
+
+    st.sidebar.toggle(
+        "🔬 Show timings", key="debug_timings",
+        help="Per-stage breakdown (client spans and backend Server-Timing) under each answer"
+    )
+    
+    st.sidebar.divider()
+
+    metrics = st.session_state["gen_metrics"]
+    if metrics["cancelled"]:
+        st.sidebar.caption(
+            f"⏹ {metrics['cancelled']} stopped · ~{int(metrics['llm_seconds_saved'])}s LLM time saved"
+        )
+    
+    with st.sidebar:
+        knowledge_base_panel()
+        conversation_panel()
+
+    hit_rate = st.session_state['history_prefetch'].hit_rate()
+    if hit_rate is not None:
+        st.sidebar.caption(f"⚡ Prefetch hit rate: {hit_rate:.0%}")
+
+    pool = get_backend_pool()
+    if len(pool) > 1:
+        with st.sidebar.expander("🖧 Backends", expanded=False):
+            for backend in pool.stats():
+                latency = f"{backend['ewma_ms']:.0f} ms" if backend["ewma_ms"] is not None else "–"
+                error_rate = backend["errors"] / backend["requests"] if backend["requests"] else 0.0
+                st.caption(
+                    f"{'🟢' if backend['healthy'] else '🔴'} {backend['url']} · {latency}"
+                    f" · {backend['outstanding']} in flight · {backend['requests']} req"
+                    f" · {error_rate:.0%} errors · {backend['hedges']} hedged"
+                )
+
+    scheduler_stats = get_request_scheduler().stats()
+    by_priority = scheduler_stats["by_priority"]
+    if any(stats["waited"] or stats["shed"] for stats in by_priority.values()):
+        with st.sidebar.expander("🚦 Request scheduler", expanded=False):
+            st.caption(f"{scheduler_stats['inflight']} in flight · {scheduler_stats['queued']} queued")
+            for name, stats in by_priority.items():
+                avg_wait = stats["wait_seconds"] / stats["waited"] * 1000 if stats["waited"] else 0.0
+                st.caption(
+                    f"{name}: {stats['started']} started · {stats['waited']} waited"
+                    f" (avg {avg_wait:.0f} ms) · {stats['shed']} shed"
+                )
+
+    footprint = st.session_state['msg_hist'].footprint()
+    if footprint["messages"]:
+        st.sidebar.caption(
+            f"🧠 Session memory: {footprint['memory_bytes'] / 1024:.1f} KB"
+            f" · spilled {footprint['spilled_bytes'] / 1024:.1f} KB"
+        )
+    
+    if st.session_state.get("show_metrics"):
+        show_metrics_page()
+        return
+
+    # ---------------- Main Chat Area ----------------
+    st.title("💬 RAG-Enabled Chatbot")
+
+    cooldown_banner()
+
+    chat_pane()
+
+    polling = bool(st.session_state["upload_jobs"])
+    st.fragment(upload_panel, run_every=JOB_POLL_BASE if polling else None)()
+
+
 
 
 
@@ -1537,38 +4881,39 @@ def show_chat_interface():
 # Main App
 # ========================================
 
-# Initialize user session
-if is_authenticated() and not st.session_state['user_info']:
-    fetch_user_info()
-
-# Load initial data if authenticated
-if is_authenticated():
-    if not st.session_state['thread_id']:
-        st.session_state['chat_thread'] = get_all_threads()
-        for tid in st.session_state['chat_thread']:
-            if tid not in st.session_state['thread_titles']:
-                messages = load_thread_history(tid)
-                if messages:
-                    st.session_state['thread_titles'][tid] = generate_chat_title(messages[0]['content'])
-                else:
-                    st.session_state['thread_titles'][tid] = f"Chat {str(tid)[:6]}"
+def chat_page():
+    load_user_data()
+    prefetch_recent_histories()
+    show_chat_interface()
 
-# Show appropriate interface
-if is_authenticated():
+    user_id = current_user_id()
+    queued_messages = user_id is not None and get_outbox().pending(user_id)[0]
+    with st.sidebar:
+        st.fragment(deliver_outbox, run_every=OUTBOX_BASE_BACKOFF if queued_messages else None)()
 
-    # # Load threads from backend once
-    # if not st.session_state['chat_thread']:
-    #     st.session_state['chat_thread'] = get_all_threads()
+init_session_state()
+restore_session()
+resume_from_cookie()
 
-    # # Ensure thread_id exists
-    # if not st.session_state['thread_id']:
-    #     new_thread_id = create_new_thread()
-    #     if new_thread_id:
-    #         st.session_state['thread_id'] = new_thread_id
-    #         st.session_state['chat_thread'].insert(0, new_thread_id)
+# Previous run may have ended in st.rerun(), so save what it changed
+persist_session()
 
-    show_chat_interface()
+if STARTUP_PROFILE:
+    report_import_profile()
 
+# Only the visible page's code runs; the login page never touches the
+# backend, and the chat page's one-time loading sits in load_user_data
+if is_authenticated():
+    page = st.navigation(
+        [st.Page(chat_page, title="Chat", url_path="chat")], position="hidden"
+    )
 else:
-    show_login_page()
+    page = st.navigation(
+        [st.Page(show_login_page, title="Login", url_path="login")], position="hidden"
+    )
+page.run()
+
+persist_session()
+sync_sid_cookie()
+sync_resume_cookie()
     